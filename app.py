@@ -1,129 +1,349 @@
 import streamlit as st
-import pandas as pd
-import csv
-from datetime import datetime, timedelta
-from collections import defaultdict, Counter
+import cProfile
+import hashlib
+from datetime import datetime
 import io
-import statistics
-
+import logging
+import os
+import pandas as pd
+import pstats
+import tempfile
+import tracemalloc
 
-st.set_page_config(page_title="Анализ Noshow", page_icon="✈️", layout="wide")
+from noshow_engine import (
+    DAYS_ORDER, HISTORY_DB_NAME, HISTORY_DIR, MEDIAN_EXACT_LIMIT, MIN_RELIABLE_SAMPLES, RUSSIAN_DAYS_FULL,
+    STREAMING_THRESHOLD_BYTES, DatasetCache, StageTimer, build_summary_table, dataset_window, forecast_table, history_version,
+    import_into_history, load_history, load_history_index, log_stages, logger, most_common_segment, parse_flights_file,
+    parse_flights_files, recommended_overbooking, stream_date_index, stream_flights_file, summary_csv, weekday_stats_table,
+    worst_day,
+)
+from noshow_simulation import MC_SCENARIOS, risk_table, simulate_flight
 
-st.title("✈️ Калькулятор NoShow для авиарейсов")
-st.markdown("---")
 
-uploaded_file = st.file_uploader("Загрузите CSV файл с данными рейсов", type=['csv'])
+@st.cache_resource
+def dataset_cache():
+    """Один DatasetCache на процесс сервера — общий для всех сессий (бюджет — NOSHOW_CACHE_MB)."""
+    return DatasetCache()
 
-if uploaded_file is not None:
-    try:
-        encodings_to_try = ['utf-8-sig', 'windows-1251', 'cp1251', 'iso-8859-1', 'utf-8']
 
-        content = None
+def from_cache(key, spinner, load):
+    """Датасет из общего кэша; если его там нет — load() под спиннером.
 
-        for encoding in encodings_to_try:
-            try:
-                uploaded_file.seek(0)
-                content = uploaded_file.getvalue().decode(encoding)
-                break
-            except UnicodeDecodeError:
-                continue
+    Результат отдаётся без копирования и общий для сессий, поэтому его нельзя менять на месте.
+    """
+    cache = dataset_cache()
+    dataset = cache.get(key)
+    if dataset is None:
+        with st.spinner(spinner):
+            dataset = cache.get_or_load(key, load)
+    return dataset
 
-        if content is None:
-            uploaded_file.seek(0)
-            content = uploaded_file.getvalue().decode('utf-8', errors='replace')
 
-        lines = content.split('\n')
+def load_dataset(file_hash, uploaded_files):
+    """Кэш разбора по хэшу содержимого: слайдер и выбор рейсов не перечитывают файлы заново."""
+    return from_cache(('upload', file_hash), "Разбираем файл...", lambda: parse_uploads(uploaded_files))
 
-        data_start_index = -1
-        for i, line in enumerate(lines):
-            if 'Рейс;Дата;Частота;Сегмент;' in line:
-                data_start_index = i
-                break
 
-        if data_start_index == -1:
-            for i, line in enumerate(lines):
-                if line.startswith('N4-') and line.count(';') > 10:
-                    data_start_index = i - 1
-                    break
+def parse_uploads(uploaded_files):
+    """Разбор загруженных файлов без кэша (его же зовёт load_dataset): несколько файлов — параллельно."""
+    if len(uploaded_files) > 1:
+        return parse_flights_files([uploaded_file.getvalue() for uploaded_file in uploaded_files])
+    uploaded_file = uploaded_files[0]
+    if uploaded_file.size > STREAMING_THRESHOLD_BYTES:
+        uploaded_file.seek(0)
+        # строки по датам большого файла держать незачем, пока не выбран период (load_upload_index)
+        return stream_flights_file(uploaded_file, date_index=False)
+    return parse_flights_file(uploaded_file.getvalue())
 
-        if data_start_index >= 0 and data_start_index + 1 < len(lines):
-            header_line = lines[data_start_index].strip()
-            data_lines = lines[data_start_index + 1:]
 
-            data_lines = [line.strip() for line in data_lines if line.strip() and line.count(';') > 5]
+def load_upload_index(file_hash, uploaded_file):
+    """DateIndex потоково разобранной загрузки — строится, только когда выбирают период или затухание."""
+    def load():
+        uploaded_file.seek(0)
+        return stream_date_index(uploaded_file)
+    return from_cache(('upload_index', file_hash), "Строим индекс по датам...", load)
 
-            if data_lines:
-                csv_content = header_line + '\n' + '\n'.join(data_lines)
 
-                csv_file = io.StringIO(csv_content)
-                reader = csv.DictReader(csv_file, delimiter=';')
+def load_history_dataset(history_dir, version):
+    """Кэш готовой статистики истории; новая версия (после импорта) читается заново, старая вытесняется."""
+    return from_cache(('history', history_dir, version), "Загружаем историю...", lambda: load_history(history_dir))
 
-                # data_list по дню недели теперь хранит: bkd, nsh, segment, den_brd, date
-                flights_data = defaultdict(lambda: defaultdict(list))
-                all_flights = set()
-                flight_segments = defaultdict(Counter)  # частоты сегментов на рейс
-                total_rows = 0
-                skipped_rows = 0
 
-                # проверка, есть ли колонка Den Brd в файле вообще
-                has_den_brd = False
+def load_history_index_cached(history_dir, version):
+    """Кэш индекса дат истории для выбора периода; читается только когда период или затухание включены."""
+    return from_cache(('history_index', history_dir, version), "Читаем историю по датам...",
+                      lambda: load_history_index(history_dir))
 
-                for row in reader:
-                    try:
-                        flight_number = row.get('Рейс', '').strip()
-                        if not flight_number:
-                            skipped_rows += 1
-                            continue
 
-                        date_str = row.get('Дата', '')
-                        if not date_str:
-                            skipped_rows += 1
-                            continue
+# Больше стольких выбранных рейсов вкладки не строим — подробности показываем по одному рейсу
+MAX_FLIGHT_TABS = 10
 
-                        date_obj = datetime.strptime(date_str, '%d.%m.%Y')
-                        day_name = date_obj.strftime('%A')
 
-                        bkd_str = row.get('Seg Bkd Total', '0').strip()
-                        nsh_str = row.get('Nsh', '0').strip()
-                        den_brd_str = row.get('Den Brd', '0').strip()
+def show_flight_details(flight, dataset, risk_factor):
+    """Подробности по рейсу: таблицы статистики по дням недели и прогноза, рекомендации и риск овербукинга.
 
-                        if 'Den Brd' in row:
-                            has_den_brd = True
+    Статистика и прогноз уходят в браузер одной таблицей каждая, а не строкой на день.
+    """
+    day_stats = dataset['day_stats'][flight]
+    flight_segment = most_common_segment(dataset['flight_segments'], flight)
+    has_den_brd = dataset['has_den_brd']
 
-                        bkd = int(float(bkd_str)) if bkd_str and bkd_str != '' else 0
-                        nsh = int(float(nsh_str)) if nsh_str and nsh_str != '' else 0
-                        den_brd = int(float(den_brd_str)) if den_brd_str and den_brd_str != '' else 0
+    st.subheader(f"📊 Статистика для рейса {flight} {flight_segment}")
 
-                        segment = row.get('Сегмент', '').strip()
+    col1, col2 = st.columns(2)
 
-                        flights_data[flight_number][day_name].append(
-                            {'bkd': bkd, 'nsh': nsh, 'segment': segment, 'den_brd': den_brd, 'date': date_obj}
-                        )
-                        all_flights.add(flight_number)
+    with col1:
+        st.markdown("**Статистика по дням недели:**")
+        if day_stats:
+            st.dataframe(weekday_stats_table(day_stats, has_den_brd), hide_index=True, use_container_width=True)
+            if has_den_brd and any(s['total_den_brd'] > 0 for s in day_stats.values()):
+                st.caption("🚫 = в эти дни недели уже отказывали в посадке (Den Brd) — "
+                           "признак, что текущий уровень овербукинга уже был рискованным.")
+        else:
+            st.warning("Нет данных для выбранного рейса")
+
+    with col2:
+        st.markdown("**📈 Прогноз на ближайшую неделю:**")
+        st.caption(f"С учётом коэффициента агрессивности {risk_factor:.2f} (слайдер слева)")
+        if day_stats:
+            st.dataframe(forecast_table(day_stats, risk_factor, datetime.now().date()),
+                         hide_index=True, use_container_width=True)
+        else:
+            st.warning("Нет данных для прогноза")
+
+    if day_stats:
+        max_rate_day = worst_day(day_stats)
+        s = day_stats[max_rate_day]
+
+        st.subheader("💡 Рекомендации")
+        reliability_note = "" if s['reliable'] else (
+            f" ⚠️ Основано всего на {s['count']} наблюдениях — "
+            f"рекомендуем не полагаться на эту цифру, пока не накопится минимум {MIN_RELIABLE_SAMPLES}."
+        )
+        st.info(f"**Самый высокий NoShow rate в {RUSSIAN_DAYS_FULL.get(max_rate_day, max_rate_day)}**: "
+                f"{s['rate']:.3f} ± {s['rate_std']:.3f} (медиана {s['rate_median']:.3f}), "
+                f"{s['rate']*100:.1f}%{reliability_note}")
+
+        recommended_level = recommended_overbooking(s, risk_factor)
+        st.success(f"**Рекомендуемый овербукинг для {RUSSIAN_DAYS_FULL.get(max_rate_day, max_rate_day)}**: "
+                   f"{recommended_level} доп. мест "
+                   f"(при коэффициенте агрессивности {risk_factor:.2f})")
+
+        # моделируем дни недели рейса по историческим rate (рекомендация не выше avg_bookings * rate,
+        # поэтому всегда попадает в перебираемые уровни)
+        weekday = DAYS_ORDER.index(max_rate_day)
+        simulation = simulate_flight(dataset['group_stats'], dataset['rate_distributions'], flight)
+        if (flight, weekday, recommended_level) in simulation.index:
+            risk = simulation.loc[(flight, weekday, recommended_level)]
+            st.markdown(f"🎲 **Моделирование ({MC_SCENARIOS} сценариев по прошлым датам)**: при "
+                        f"{recommended_level} доп. местах в среднем {risk['expected_empty_seats']:.1f} пустых кресел, "
+                        f"вероятность отказа в посадке (Den Brd > 0) — {risk['p_denied']:.1%}")
+            with st.expander("🎲 Риск по уровням овербукинга"):
+                st.dataframe(risk_table(simulation, flight, weekday, recommended_level), hide_index=True,
+                             use_container_width=True)
+                st.caption("Вместимость принята равной среднему числу бронирований в этот день недели; "
+                           "исход каждого сценария — NoShow rate одной из прошлых дат.")
+
+        if has_den_brd and s['total_den_brd'] > 0:
+            st.warning(
+                f"На этот день недели уже были случаи Den Brd "
+                f"({s['total_den_brd']} пассажиров). Рекомендуем не увеличивать "
+                f"коэффициент агрессивности выше текущего."
+            )
+
+
+# Сколько строк профиля показывать в панели диагностики (файл для скачивания — полный)
+PROFILE_SUMMARY_LINES = 30
+
+
+def start_capture(kind):
+    """Включает профилировщик для одного запуска: cProfile (время по функциям) или tracemalloc (память).
+
+    Возвращает профилировщик (для tracemalloc — True) или None, если tracemalloc уже снимает
+    другая сессия: трассировка одна на процесс.
+    """
+    if kind == 'cProfile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    return StageTimer.start_tracing() or None
+
+
+def finish_capture(kind, profiler):
+    """Останавливает профилировщик; возвращает {'file_name', 'data', 'mime', 'summary'} для скачивания."""
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if kind == 'cProfile':
+        profiler.disable()
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+        # .prof открывается snakeviz / python -m pstats
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'noshow.prof')
+            profiler.dump_stats(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+        return {'file_name': f"noshow_profile_{stamp}.prof", 'data': data, 'mime': 'application/octet-stream',
+                'summary': summary.getvalue()}
+
+    # что осталось занятым к концу запуска, по строкам кода; пики по этапам — в таблицах панели
+    snapshot = tracemalloc.take_snapshot()
+    StageTimer.stop_tracing()
+    lines = [str(stat) for stat in snapshot.statistics('lineno')[:200]]
+    return {'file_name': f"noshow_memory_{stamp}.txt", 'data': "\n".join(lines).encode('utf-8'),
+            'mime': 'text/plain', 'summary': "\n".join(lines[:PROFILE_SUMMARY_LINES])}
+
+
+def stages_table(stages):
+    """Замеры StageTimer таблицей для панели диагностики."""
+    return pd.DataFrame([{
+        'Этап': entry['stage'],
+        'Время, с': round(entry['seconds'], 4),
+        'Пик, МБ': round(entry['peak_mb'], 1) if entry['peak_mb'] is not None else None,
+        'Пик RSS процесса, МБ': round(entry['rss_peak_mb']) if entry.get('rss_peak_mb') is not None else None,
+        'Строк': entry['rows'],
+        'Строк/с': round(entry['rows_per_s']) if entry['rows_per_s'] else None,
+    } for entry in stages])
 
-                        if segment:
-                            flight_segments[flight_number][segment] += 1
 
-                        total_rows += 1
+st.set_page_config(page_title="Анализ Noshow", page_icon="✈️", layout="wide")
 
-                    except (KeyError, ValueError, TypeError):
-                        skipped_rows += 1
-                        continue
+st.title("✈️ Калькулятор NoShow для авиарейсов")
+st.markdown("---")
 
-                st.success(f"✅ Файл успешно обработан! Записей: {total_rows}, Рейсов: {len(all_flights)}"
-                           + (f", пропущено строк: {skipped_rows}" if skipped_rows else ""))
+uploaded_files = st.file_uploader(
+    "Загрузите CSV файлы с данными рейсов", type=['csv'], accept_multiple_files=True,
+    help="Можно выбрать сразу несколько выгрузок (по месяцам или группам рейсов) — они разбираются параллельно. "
+         "Строка Рейс+Дата+Сегмент, которая есть в нескольких файлах, учитывается один раз — из файла ниже по списку."
+)
+
+st.sidebar.markdown("### 📚 История рейсов")
+use_history = st.sidebar.checkbox(
+    "Копить выгрузки в локальной истории",
+    value=history_version(HISTORY_DIR) > 0,
+    help="Каждая новая выгрузка добавляется в базу (повторы Рейс+Дата+Сегмент заменяются), "
+         "а анализ строится по всей накопленной истории. Загружать старые файлы заново не нужно."
+)
+if use_history:
+    st.sidebar.caption(f"База истории: {os.path.join(HISTORY_DIR, HISTORY_DB_NAME)}")
+
+st.sidebar.markdown("### 🩺 Диагностика")
+diagnostics = st.sidebar.checkbox(
+    "Режим диагностики",
+    help="Показывает время, пик памяти и скорость (строк/с) по этапам разбора и отрисовки "
+         "и пишет их в лог (логгер noshow, по JSON-строке на этап)."
+)
+capture_kind = None
+if diagnostics:
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    selected_capture = st.sidebar.selectbox(
+        "Профиль одного запуска", ['cProfile', 'tracemalloc'],
+        help="cProfile — время по функциям, tracemalloc — память по строкам кода (и пик памяти по этапам). "
+             "Файл при этом разбирается заново, без кэша."
+    )
+    if st.sidebar.button("▶ Снять профиль"):
+        capture_kind = selected_capture
+    diagnostics_panel = st.sidebar.expander("🩺 Замеры по этапам", expanded=True)
+
+run_timer = StageTimer()
+dataset = None
+import_stages = []
+
+# профиль снимается только на этот блок; st.rerun/st.stop и прерывание запуска Streamlit бросают
+# BaseException мимо except Exception ниже — профилировщик выключается в finally при любом исходе
+capture_done = False
+try:
+    if capture_kind:
+        profiler = start_capture(capture_kind)
+        if profiler is None:
+            st.sidebar.warning("Профиль памяти сейчас снимается в другой сессии — попробуйте чуть позже.")
+            capture_kind = None
+    if uploaded_files or use_history:
+        try:
+            streaming = False
+            file_hashes = []
+
+            if uploaded_files:
+                with run_timer.stage('hash'):
+                    # хэш загрузки считаем один раз за сессию: на повторных прогонах берём его по file_id
+                    upload_hashes = st.session_state.setdefault('upload_hashes', {})
+                    for uploaded_file in uploaded_files:
+                        if uploaded_file.file_id not in upload_hashes:
+                            # хэшируем прямо буферы загрузки, без лишней копии байтов
+                            upload_hashes[uploaded_file.file_id] = hashlib.sha256(
+                                uploaded_file.getbuffer()).hexdigest()
+                    file_hashes = [upload_hashes[uploaded_file.file_id] for uploaded_file in uploaded_files]
+                # ключ набора файлов учитывает и порядок: при повторах строк побеждает файл ниже по списку
+                file_hash = file_hashes[0] if len(file_hashes) == 1 else hashlib.sha256(
+                    ' '.join(file_hashes).encode('ascii')).hexdigest()
+                streaming = len(uploaded_files) == 1 and uploaded_files[0].size > STREAMING_THRESHOLD_BYTES
+
+            if use_history:
+                # результат импорта помним в сессии, чтобы повторные запуски скрипта не ходили в базу
+                history_imports = st.session_state.setdefault('history_imports', {})
+                for uploaded_file, single_hash in zip(uploaded_files or [], file_hashes):
+                    if single_hash not in history_imports:
+                        with st.spinner(f"Добавляем {uploaded_file.name} в историю..."):
+                            history_imports[single_hash] = import_into_history(
+                                HISTORY_DIR, single_hash, uploaded_file, uploaded_file.size > STREAMING_THRESHOLD_BYTES)
+                        if diagnostics:
+                            log_stages(history_imports[single_hash].get('stages', []), phase='import',
+                                       file_hash=single_hash[:12])
+                    imported = history_imports[single_hash]
+                    import_stages += imported.get('stages', [])
+                    name = f"{uploaded_file.name}: " if len(uploaded_files) > 1 else ""
+                    if imported['error']:
+                        st.error(name + imported['error'])
+                    elif imported['already_imported']:
+                        st.info(f"ℹ️ {name}этот файл уже есть в истории — повторно не добавляем")
+                    else:
+                        st.success(f"📚 {name}выгрузка добавлена в историю: записей {imported['total_rows']}"
+                                   + (f", пропущено строк: {imported['skipped_rows']}" if imported['skipped_rows'] else ""))
+                version = history_version(HISTORY_DIR)
+                if version:
+                    with run_timer.stage('load'):
+                        # при снятии профиля — мимо кэша, иначе профилировать было бы нечего
+                        dataset = load_history(HISTORY_DIR) if capture_kind else load_history_dataset(HISTORY_DIR, version)
+            else:
+                with run_timer.stage('load'):
+                    dataset = parse_uploads(uploaded_files) if capture_kind else load_dataset(file_hash, uploaded_files)
 
-                # Порог, ниже которого выборка считается ненадёжной
-                MIN_RELIABLE_SAMPLES = 5
+            if dataset is None:
+                st.info("👆 История пока пуста — загрузите первую выгрузку из Leonardo")
+            elif dataset['error']:
+                st.error(dataset['error'])
+            else:
+                flight_day_stats = dataset['day_stats']
+                all_flights = dataset['all_flights']
+                flight_segments = dataset['flight_segments']
+                has_den_brd = dataset['has_den_brd']
+                total_rows = dataset['total_rows']
+                skipped_rows = dataset['skipped_rows']
+
+                if use_history:
+                    st.success(f"✅ История загружена! Записей: {total_rows}, Рейсов: {len(all_flights)}")
+                elif len(uploaded_files) > 1:
+                    for index, error in dataset['file_errors'].items():
+                        st.warning(f"{uploaded_files[index].name}: {error}")
+                    st.success(f"✅ Файлы обработаны ({len(uploaded_files) - len(dataset['file_errors'])})! "
+                               f"Записей: {total_rows}, Рейсов: {len(all_flights)}"
+                               + (f", пропущено строк: {skipped_rows}" if skipped_rows else ""))
+                    if dataset['duplicate_rows']:
+                        st.caption(f"Строк, которые есть сразу в нескольких файлах: {dataset['duplicate_rows']} — "
+                                   "каждая учтена один раз, из файла ниже по списку.")
+                else:
+                    st.success(f"✅ Файл успешно обработан! Записей: {total_rows}, Рейсов: {len(all_flights)}"
+                               + (f", пропущено строк: {skipped_rows}" if skipped_rows else ""))
+                if streaming and not use_history:
+                    st.caption(f"Файл больше {STREAMING_THRESHOLD_BYTES // (1024 * 1024)} МБ и разобран потоково: "
+                               f"медиана точная, пока у дня недели не больше {MEDIAN_EXACT_LIMIT} наблюдений.")
 
                 if all_flights:
-                    def most_common_segment(flight):
-                        counter = flight_segments.get(flight)
-                        if counter:
-                            return counter.most_common(1)[0][0]
-                        return 'Не определен'
-
-                    flight_options = [f"{flight} ({most_common_segment(flight)})" for flight in sorted(all_flights)]
+                    flight_options = [f"{flight} ({most_common_segment(flight_segments, flight)})"
+                                      for flight in sorted(all_flights)]
 
                     selected_flights_with_segments = st.multiselect(
                         "Выберите рейсы для анализа:",
@@ -142,194 +362,91 @@ if uploaded_file is not None:
                              "Меньшие значения снижают риск отказа в посадке (Den Brd) ценой части незанятых кресел."
                     )
 
-                    days_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-                    russian_days_full = {
-                        'Monday': 'Понедельник', 'Tuesday': 'Вторник', 'Wednesday': 'Среда',
-                        'Thursday': 'Четверг', 'Friday': 'Пятница', 'Saturday': 'Суббота', 'Sunday': 'Воскресенье'
-                    }
-                    russian_days_short = {
-                        'Monday': 'Пн', 'Tuesday': 'Вт', 'Wednesday': 'Ср', 'Thursday': 'Чт',
-                        'Friday': 'Пт', 'Saturday': 'Сб', 'Sunday': 'Вс'
-                    }
-
-                    def compute_day_stats(data_list):
-                        """Считает rate, среднее bkd, std, кол-во наблюдений и Den Brd статистику по списку записей одного дня."""
-                        bkd_values = [d['bkd'] for d in data_list]
-                        nsh_values = [d['nsh'] for d in data_list]
-                        den_brd_values = [d['den_brd'] for d in data_list]
-
-                        total_bkd = sum(bkd_values)
-                        total_nsh = sum(nsh_values)
-                        count = len(data_list)
-
-                        rate = total_nsh / total_bkd if total_bkd > 0 else 0.0
-                        avg_bookings = total_bkd // count if count else 0
-
-                        # per-flight rate для std (а не общий rate) — чтобы видеть разброс между датами
-                        per_flight_rates = [
-                            (d['nsh'] / d['bkd']) if d['bkd'] > 0 else 0.0 for d in data_list
-                        ]
-                        rate_std = statistics.pstdev(per_flight_rates) if count > 1 else 0.0
-                        rate_median = statistics.median(per_flight_rates) if count else 0.0
-
-                        flights_with_den_brd = sum(1 for v in den_brd_values if v > 0)
-                        total_den_brd = sum(den_brd_values)
-                        den_brd_share = flights_with_den_brd / count if count else 0.0
-
-                        return {
-                            'rate': rate,
-                            'rate_median': rate_median,
-                            'rate_std': rate_std,
-                            'avg_bookings': avg_bookings,
-                            'count': count,
-                            'total_bkd': total_bkd,
-                            'total_nsh': total_nsh,
-                            'den_brd_share': den_brd_share,
-                            'total_den_brd': total_den_brd,
-                            'reliable': count >= MIN_RELIABLE_SAMPLES,
-                        }
+                    # период и затухание: вся статистика ниже строится по view, а не по всему dataset
+                    view = dataset
+                    if dataset['date_range']:
+                        first_date, last_date = dataset['date_range']
+                        st.sidebar.markdown("### 📅 Период анализа")
+                        period = (first_date, last_date)
+                        if first_date < last_date:
+                            period = st.sidebar.slider(
+                                "Даты рейсов", min_value=first_date, max_value=last_date, value=period,
+                                format="DD.MM.YYYY",
+                                help="Статистика, прогноз и моделирование строятся только по датам из этого периода — "
+                                     "например, по одному сезону."
+                            )
+                        half_life = None
+                        if st.sidebar.checkbox("Больший вес свежим датам",
+                                               help="Экспоненциальное затухание: чем старше дата, тем меньше она влияет "
+                                                    "на rate, медиану, разброс и среднее число бронирований."):
+                            half_life = st.sidebar.slider(
+                                "Период полураспада, дней", min_value=14, max_value=730, value=180, step=7,
+                                help="Каждые столько дней в прошлое вес даты уменьшается вдвое."
+                            )
+                        if period != (first_date, last_date) or half_life:
+                            with run_timer.stage('window'):
+                                date_index = dataset['date_index']
+                                if date_index is None and use_history:
+                                    date_index = load_history_index_cached(HISTORY_DIR, version)
+                                elif date_index is None:
+                                    date_index = load_upload_index(file_hash, uploaded_files[0])
+                                view = dataset_window(dataset, period[0], period[1], half_life, date_index=date_index)
+                            st.caption(f"📅 Период {period[0]:%d.%m.%Y} – {period[1]:%d.%m.%Y}: записей {view['total_rows']}"
+                                       + (f", вес даты падает вдвое каждые {half_life} дн." if half_life else ""))
+                    flight_day_stats = view['day_stats']
 
                     if selected_flights:
-                        tabs = st.tabs([f"✈️ {flight}" for flight in selected_flights])
-
-                        for i, flight in enumerate(selected_flights):
-                            with tabs[i]:
-                                flight_daily_data = flights_data[flight]
-                                day_stats = {day: compute_day_stats(data_list)
-                                             for day, data_list in flight_daily_data.items() if data_list}
-                                flight_segment = most_common_segment(flight)
-
-                                st.subheader(f"📊 Статистика для рейса {flight} {flight_segment}")
-
-                                col1, col2 = st.columns(2)
-
-                                with col1:
-                                    st.markdown("**Статистика по дням недели:**")
-                                    if day_stats:
-                                        for day in days_order:
-                                            if day in day_stats:
-                                                s = day_stats[day]
-                                                reliability_flag = "" if s['reliable'] else " ⚠️ мало данных"
-                                                line = (f"**{russian_days_full[day]}**: Rate={s['rate']:.3f} "
-                                                        f"(±{s['rate_std']:.3f}), Медиана={s['rate_median']:.3f}, "
-                                                        f"Noshow={s['total_nsh']}, "
-                                                        f"Bookings={s['total_bkd']}, Рейсов={s['count']}{reliability_flag}")
-                                                st.write(line)
-                                                if has_den_brd and s['total_den_brd'] > 0:
-                                                    st.caption(
-                                                        f"⚠️ Отказано в посадке (Den Brd) в {s['den_brd_share']*100:.0f}% "
-                                                        f"рейсов этого дня, всего {s['total_den_brd']} пассажиров — "
-                                                        f"признак, что текущий уровень овербукинга уже был рискованным."
-                                                    )
-                                            else:
-                                                st.write(f"**{russian_days_full[day]}**: Нет данных")
-                                    else:
-                                        st.warning("Нет данных для выбранного рейса")
-
-                                with col2:
-                                    st.markdown("**📈 Прогноз на ближайшую неделю:**")
-                                    st.caption(f"С учётом коэффициента агрессивности {risk_factor:.2f} (слайдер слева)")
-                                    today = datetime.now().date()
-
-                                    if day_stats:
-                                        for d in range(7):
-                                            future_date = today + timedelta(days=d)
-                                            day_name_en = future_date.strftime('%A')
-                                            day_name_ru = russian_days_full.get(day_name_en, day_name_en)
-
-                                            s = day_stats.get(day_name_en)
-                                            if s:
-                                                predicted_noshow_mean = s['avg_bookings'] * s['rate'] * risk_factor
-                                                predicted_noshow_median = s['avg_bookings'] * s['rate_median'] * risk_factor
-                                                reliability_flag = "" if s['reliable'] else " ⚠️"
-                                                st.write(f"**{future_date.strftime('%d.%m.%Y')}** ({day_name_ru}) - "
-                                                         f"{predicted_noshow_mean:.1f} NoShow (по среднему) / "
-                                                         f"{predicted_noshow_median:.1f} (по медиане){reliability_flag}")
-                                            else:
-                                                st.write(f"**{future_date.strftime('%d.%m.%Y')}** ({day_name_ru}) - нет данных")
-                                    else:
-                                        st.warning("Нет данных для прогноза")
-
-                                if day_stats:
-                                    max_rate_day = max(day_stats, key=lambda d: day_stats[d]['rate'])
-                                    s = day_stats[max_rate_day]
-
-                                    st.subheader("💡 Рекомендации")
-                                    reliability_note = "" if s['reliable'] else (
-                                        f" ⚠️ Основано всего на {s['count']} наблюдениях — "
-                                        f"рекомендуем не полагаться на эту цифру, пока не накопится минимум {MIN_RELIABLE_SAMPLES}."
-                                    )
-                                    st.info(f"**Самый высокий NoShow rate в {russian_days_full.get(max_rate_day, max_rate_day)}**: "
-                                            f"{s['rate']:.3f} ± {s['rate_std']:.3f} (медиана {s['rate_median']:.3f}), "
-                                            f"{s['rate']*100:.1f}%{reliability_note}")
-
-                                    recommended_overbooking = int(s['avg_bookings'] * s['rate'] * risk_factor)
-
-                                    st.success(f"**Рекомендуемый овербукинг для {russian_days_full.get(max_rate_day, max_rate_day)}**: "
-                                               f"{recommended_overbooking} доп. мест "
-                                               f"(при коэффициенте агрессивности {risk_factor:.2f})")
-
-                                    if has_den_brd and s['total_den_brd'] > 0:
-                                        st.warning(
-                                            f"На этот день недели уже были случаи Den Brd "
-                                            f"({s['total_den_brd']} пассажиров). Рекомендуем не увеличивать "
-                                            f"коэффициент агрессивности выше текущего."
-                                        )
+                        with run_timer.stage('render'):
+                            if len(selected_flights) <= MAX_FLIGHT_TABS:
+                                tabs = st.tabs([f"✈️ {flight}" for flight in selected_flights])
+                                for tab, flight in zip(tabs, selected_flights):
+                                    with tab:
+                                        show_flight_details(flight, view, risk_factor)
+                            else:
+                                # вкладки строятся все сразу — при сотнях рейсов страница перестаёт отвечать,
+                                # поэтому подробности показываем только для одного рейса
+                                st.caption(f"Выбрано рейсов: {len(selected_flights)}. Подробности показываем по одному рейсу, "
+                                           f"все рейсы — в сводной таблице ниже.")
+                                flight = st.selectbox(
+                                    "Рейс для подробного просмотра:",
+                                    selected_flights,
+                                    format_func=lambda flight: f"✈️ {flight} ({most_common_segment(flight_segments, flight)})"
+                                )
+                                show_flight_details(flight, view, risk_factor)
 
                         st.markdown("---")
                         st.subheader("📋 Сводная таблица по всем рейсам")
 
-                        summary_data = []
-
-                        for flight in selected_flights:
-                            flight_daily_data = flights_data[flight]
-                            flight_segment = most_common_segment(flight)
-
-                            row_data = {
-                                'Рейс': flight,
-                                'Сегмент': flight_segment
-                            }
-
-                            for day in days_order:
-                                if day in flight_daily_data and flight_daily_data[day]:
-                                    s = compute_day_stats(flight_daily_data[day])
-                                    flag = "" if s['reliable'] else "⚠️"
-                                    den_flag = " 🚫" if (has_den_brd and s['total_den_brd'] > 0) else ""
-                                    row_data[russian_days_short[day]] = (
-                                        f"{s['rate']:.3f} / мед.{s['rate_median']:.3f}"
-                                        f"{flag}{den_flag} (n={s['count']})"
-                                    )
-                                else:
-                                    row_data[russian_days_short[day]] = "Н/Д"
-
-                            summary_data.append(row_data)
-
-                        if summary_data:
-                            summary_df = pd.DataFrame(summary_data)
+                        with run_timer.stage('summary', rows=len(selected_flights)):
+                            summary_df = build_summary_table(flight_day_stats, selected_flights, flight_segments,
+                                                             has_den_brd)
+
+                        if len(summary_df):
                             st.dataframe(summary_df, use_container_width=True)
                             st.caption("⚠️ = меньше 5 наблюдений (ненадёжная оценка). "
                                        "🚫 = на этот день недели уже фиксировался отказ в посадке (Den Brd).")
 
-                            csv_summary = summary_df.to_csv(index=False, encoding='utf-8-sig')
                             st.download_button(
                                 label="📥 Скачать сводную таблицу",
-                                data=csv_summary,
+                                data=summary_csv(summary_df),
                                 file_name=f"noshow_summary_{datetime.now().strftime('%Y%m%d')}.csv",
                                 mime="text/csv"
                             )
 
                 else:
                     st.error("❌ Не найдено данных о рейсах в файле")
-            else:
-                st.error("❌ Не найдено данных в файле")
-        else:
-            st.error("❌ Не удалось найти данные в файле")
-
-    except Exception as e:
-        st.error(f"❌ Ошибка при обработке файла: {e}")
-
-else:
-    st.info("👆 Пожалуйста, загрузите CSV файл для начала анализа")
+        except Exception as e:
+            st.error(f"❌ Ошибка при обработке файла: {e}")
+
+    else:
+        st.info("👆 Пожалуйста, загрузите CSV файл для начала анализа")
+    capture_done = True
+finally:
+    if capture_kind:
+        capture = finish_capture(capture_kind, profiler)
+        # профиль прерванного запуска неполный — показываем только законченные
+        if capture_done:
+            st.session_state['diagnostics_capture'] = capture
 
 with st.expander("ℹ️ Инструкция по использованию калькулятора"):
     st.markdown("""
@@ -338,7 +455,7 @@ with st.expander("ℹ️ Инструкция по использованию к
     - **Обычно ничего при сохранении менять не надо, но проверьте что файл сохраняется в csv формате с кодировкой Windows-1251**
     - **Загружаете файл сюда**
     - **!!!АХТУНГ!!! Данный анализ лишь прогноз на основе исторических данных за период, выгруженный из Leonardo, окончательное решение об овербукинге принимайте сами**
-    - **По хорошему вести отдельный файл и раз в месяц выгружать данные для анализа в него, чтобы выбросы меньше влияли на прогноз. С другой стороны сезонность тоже влияет так что думойте....**
+    - **По хорошему копить историю: включите "Копить выгрузки в локальной истории" в боковой панели и раз в месяц загружайте только свежую выгрузку — старые данные уже в базе, выбросы меньше влияют на прогноз. С другой стороны сезонность тоже влияет так что думойте....**
     - **Для защиты данных можно поменять названия/номера рейсов в csv файле на что угодно (ctrl+f)**
 
     **Что нового в этой версии:**
@@ -346,5 +463,44 @@ with st.expander("ℹ️ Инструкция по использованию к
     - **Доверие к оценке (⚠️)** — если по дню недели меньше 5 наблюдений, оценка помечается как ненадёжная, чтобы не переоценивать точность прогноза на малой выборке.
     - **Разброс (± std)** — рядом со средним noshow rate показывается разброс между рейсами, чтобы видеть, насколько стабильна оценка.
     - **Регулятор агрессивности овербукинга** — слайдер в боковой панели позволяет вручную снижать рекомендованный овербукинг относительно "чистого" прогноза, компенсируя асимметрию рисков (пустое кресло дешевле отказа в посадке).
+    - **Локальная история** — выгрузки можно копить в базе на диске: новая выгрузка добавляется к старым (повторы Рейс+Дата+Сегмент заменяются), и при открытии калькулятора история доступна сразу, без повторной загрузки файлов.
+    - **Моделирование риска (🎲)** — рядом с рекомендацией показано, сколько кресел в среднем останется пустыми и с какой вероятностью придётся отказать в посадке при рекомендованном овербукинге; в раскрывающемся блоке — то же для других уровней. Сценарии берутся из NoShow rate прошлых дат этого рейса и дня недели.
+    - **Много рейсов сразу** — если выбрано больше 10 рейсов, вместо вкладок подробности показываются для одного рейса из списка (страница не подвисает), а все рейсы видны в сводной таблице.
+    - **Несколько файлов сразу** — можно выбрать несколько выгрузок (например, по месяцам): они разбираются параллельно и складываются в один анализ. Если одна и та же строка Рейс+Дата+Сегмент есть в нескольких файлах, она учитывается один раз — из файла ниже по списку.
+    - **Период и свежие даты (📅)** — в боковой панели можно ограничить анализ периодом дат (например, только летом) и включить затухание: чем старше дата, тем меньше её вес в rate, медиане и прогнозе. Так сезонность и давние выбросы меньше искажают рекомендации.
+    - **Диагностика (🩺)** — в боковой панели можно включить режим диагностики: время, скорость и пик памяти по этапам разбора и отрисовки. Кнопка «Снять профиль» заново разбирает файл под cProfile или tracemalloc, профиль можно скачать.
     - **Сегмент рейса теперь определяется как самый частый маршрут**, а не первый попавшийся — на случай, если один номер рейса летал по разным маршрутам в разные дни.
     """)
+
+if diagnostics:
+    run_stages = run_timer.report()
+    with diagnostics_panel:
+        if dataset is not None and dataset.get('stages'):
+            st.markdown("**Разбор файла**" + ("" if capture_kind else " (при первой загрузке, дальше — из кэша)"))
+            st.dataframe(stages_table(dataset['stages']), hide_index=True, use_container_width=True)
+        if import_stages:
+            st.markdown("**Импорт в историю**")
+            st.dataframe(stages_table(import_stages), hide_index=True, use_container_width=True)
+        st.markdown("**Этот запуск**")
+        st.dataframe(stages_table(run_stages), hide_index=True, use_container_width=True)
+        if not capture_kind:
+            st.caption("Пик памяти этапа меряется только при снятии профиля tracemalloc; пик RSS — максимум "
+                       "памяти всего процесса (всех сессий) к концу этапа.")
+        cached_bytes, cached_count = dataset_cache().usage()
+        st.caption(f"Кэш выгрузок (общий для всех сессий): {cached_bytes / 2 ** 20:.1f} МБ "
+                   f"из {dataset_cache().budget_bytes / 2 ** 20:.0f} МБ, датасетов: {cached_count}")
+
+        capture = st.session_state.get('diagnostics_capture')
+        if capture:
+            st.markdown("**Последний профиль**")
+            st.code(capture['summary'], language=None)
+            st.download_button("📥 Скачать профиль", data=capture['data'], file_name=capture['file_name'],
+                               mime=capture['mime'])
+
+    # разбор в лог — один раз на файл за сессию, этапы запуска — каждый раз
+    context = {'file_hash': file_hash[:12]} if uploaded_files else {'source': 'history'}
+    logged = st.session_state.setdefault('diagnostics_logged', set())
+    if dataset is not None and dataset.get('stages') and (capture_kind or id(dataset) not in logged):
+        logged.add(id(dataset))
+        log_stages(dataset['stages'], phase='parse', **context)
+    log_stages(run_stages, phase='run', **context)
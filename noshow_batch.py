@@ -0,0 +1,171 @@
+"""Пакетный (ночной) расчёт NoShow по каталогу выгрузок Leonardo без интерфейса.
+
+Каждая выгрузка разбирается в отдельном процессе; для неё пишутся те же файлы,
+что можно получить в интерфейсе при выборе всех рейсов:
+
+    python noshow_batch.py exports/ --output-dir reports/ --risk-factor 0.8
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+import glob
+import logging
+import os
+import sys
+
+import pandas as pd
+
+from noshow_engine import (
+    DAYS_ORDER, RUSSIAN_DAYS_FULL, STREAMING_THRESHOLD_BYTES, StageTimer, build_summary_table, forecast_table,
+    log_stages, logger, most_common_segment, parse_flights_file, recommended_overbooking, stream_flights_file,
+    summary_csv, worst_day,
+)
+from noshow_simulation import simulate_overbooking
+
+
+def build_forecast_table(flight_day_stats, flights, flight_segments, risk_factor, start_date):
+    """Прогноз на неделю по всем рейсам — та же таблица, что в блоке «Прогноз на ближайшую неделю»."""
+    tables = [forecast_table(flight_day_stats[flight], risk_factor, start_date).assign(
+        **{'Рейс': flight, 'Сегмент': most_common_segment(flight_segments, flight)}) for flight in flights]
+    if not tables:
+        return pd.DataFrame()
+    forecast = pd.concat(tables, ignore_index=True)
+    return forecast[['Рейс', 'Сегмент'] + [column for column in forecast.columns if column not in ('Рейс', 'Сегмент')]]
+
+
+def build_recommendations_table(flight_day_stats, flights, flight_segments, has_den_brd, risk_factor, simulation):
+    """Рекомендации по рейсам — день с самым высоким rate и овербукинг для него, как в блоке «Рекомендации»,
+    вместе с результатом моделирования для рекомендованного уровня."""
+    rows = []
+    for flight in flights:
+        day_stats = flight_day_stats[flight]
+        if not day_stats:
+            continue
+        max_rate_day = worst_day(day_stats)
+        s = day_stats[max_rate_day]
+        level = recommended_overbooking(s, risk_factor)
+        key = (flight, DAYS_ORDER.index(max_rate_day), level)
+        risk = simulation.loc[key] if key in simulation.index else None
+        rows.append({
+            'Рейс': flight,
+            'Сегмент': most_common_segment(flight_segments, flight),
+            'День недели': RUSSIAN_DAYS_FULL[max_rate_day],
+            'Rate': f"{s['rate']:.3f}",
+            'Медиана': f"{s['rate_median']:.3f}",
+            'Std': f"{s['rate_std']:.3f}",
+            'Наблюдений': s['count'],
+            'Рекомендуемый овербукинг': level,
+            'Пустых кресел (ожид.)': f"{risk['expected_empty_seats']:.1f}" if risk is not None else "Н/Д",
+            'P(Den Brd > 0)': f"{risk['p_denied']:.1%}" if risk is not None else "Н/Д",
+            'Den Brd': s['total_den_brd'] if has_den_brd else "",
+        })
+    return pd.DataFrame(rows)
+
+
+def _write_csv(path, text):
+    # тот же текст, что уходит в кнопку скачивания: utf-8, переводы строк как есть
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+
+
+def process_export(path, output_dir, risk_factor, report_date):
+    """Разбирает одну выгрузку и пишет по ней сводную таблицу, прогноз и рекомендации.
+
+    Запускается в процессе-работнике, поэтому возвращает только короткий итог:
+    словарь с ключами path, flights, total_rows, skipped_rows, outputs, stages и error.
+    """
+    # порог тот же, что в интерфейсе: большие выгрузки разбираются потоково
+    with open(path, 'rb') as f:
+        if os.path.getsize(path) > STREAMING_THRESHOLD_BYTES:
+            dataset = stream_flights_file(f, date_index=False)
+        else:
+            dataset = parse_flights_file(f.read(), date_index=False)
+    if dataset['error']:
+        return {'path': path, 'stages': dataset.get('stages', []), 'error': dataset['error']}
+    if not dataset['all_flights']:
+        return {'path': path, 'stages': dataset['stages'], 'error': "❌ Не найдено данных о рейсах в файле"}
+
+    flight_day_stats = dataset['day_stats']
+    flights = sorted(dataset['all_flights'])
+    flight_segments = dataset['flight_segments']
+    has_den_brd = dataset['has_den_brd']
+
+    stem = os.path.splitext(os.path.basename(path))[0]
+    stamp = report_date.strftime('%Y%m%d')
+    timer = StageTimer()
+    with timer.stage('simulate'):
+        simulation = simulate_overbooking(dataset['group_stats'], dataset['rate_distributions'])
+    with timer.stage('tables', rows=len(flights)):
+        outputs = {
+            os.path.join(output_dir, f"{stem}_noshow_summary_{stamp}.csv"): summary_csv(
+                build_summary_table(flight_day_stats, flights, flight_segments, has_den_brd)),
+            os.path.join(output_dir, f"{stem}_noshow_forecast_{stamp}.csv"): build_forecast_table(
+                flight_day_stats, flights, flight_segments, risk_factor, report_date).to_csv(index=False),
+            os.path.join(output_dir, f"{stem}_noshow_recommendations_{stamp}.csv"): build_recommendations_table(
+                flight_day_stats, flights, flight_segments, has_den_brd, risk_factor, simulation).to_csv(index=False),
+        }
+    with timer.stage('write'):
+        for output_path, text in outputs.items():
+            _write_csv(output_path, text)
+
+    return {'path': path, 'flights': len(flights), 'total_rows': dataset['total_rows'],
+            'skipped_rows': dataset['skipped_rows'], 'outputs': list(outputs),
+            'stages': dataset['stages'] + timer.report(), 'error': None}
+
+
+def _risk_factor(value):
+    value = float(value)
+    if not 0.3 <= value <= 1.0:
+        raise argparse.ArgumentTypeError("коэффициент агрессивности должен быть от 0.3 до 1.0")
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетный расчёт NoShow по каталогу выгрузок Leonardo.")
+    parser.add_argument('exports_dir', help="каталог с выгрузками")
+    parser.add_argument('--output-dir', default='.', help="куда писать результаты (по умолчанию текущий каталог)")
+    parser.add_argument('--risk-factor', type=_risk_factor, default=0.8,
+                        help="коэффициент агрессивности овербукинга, как слайдер в интерфейсе (0.3–1.0)")
+    parser.add_argument('--pattern', default='*.csv', help="маска файлов выгрузок (по умолчанию *.csv)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="число процессов (по умолчанию — по числу ядер)")
+    parser.add_argument('--date', type=lambda value: datetime.strptime(value, '%Y-%m-%d').date(),
+                        default=date.today(), help="первый день прогноза и дата в именах файлов, ГГГГ-ММ-ДД")
+    parser.add_argument('--diagnostics', action='store_true',
+                        help="писать в stderr время и скорость по этапам для каждого файла (JSON-строки)")
+    args = parser.parse_args(argv)
+
+    if args.diagnostics:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+    paths = sorted(glob.glob(os.path.join(args.exports_dir, args.pattern)))
+    if not paths:
+        print(f"В {args.exports_dir} нет файлов {args.pattern}", file=sys.stderr)
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(process_export, path, args.output_dir, args.risk_factor, args.date)
+                   for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'path': path, 'error': f"❌ Ошибка при обработке файла: {e}"}
+            if args.diagnostics:
+                log_stages(result.get('stages', []), file=os.path.basename(path))
+            if result['error']:
+                failed += 1
+                print(f"{path}: {result['error']}", file=sys.stderr)
+            else:
+                print(f"{path}: рейсов {result['flights']}, записей {result['total_rows']}"
+                      + (f", пропущено строк {result['skipped_rows']}" if result['skipped_rows'] else ""))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,293 @@
+"""Бенчмарк разбора и статистики на синтетических выгрузках (noshow_synth.py).
+
+Для каждого размера файла по отдельности замеряются этапы самого parse_flights_file
+(его StageTimer) и то, что интерфейс делает поверх результата:
+
+    decode     определение кодировки
+    header     поиск строки заголовка
+    parse      отбор строк данных и чтение колонок
+    aggregate  статистика по (рейс, день недели), распределения rate, сегменты
+    index      компактные строки (CompactRecords) и индекс дат (DateIndex) для выбора периода
+    build      сборка датасета и раскладка по рейсам
+    window     статистика за последние три четверти периода с затуханием — то, что
+               пересчитывается при каждом движении слайдера периода
+    summary    сводная таблица по всем рейсам
+
+Время — лучшее из --repeat прогонов без трассировки памяти; пик памяти — отдельным
+прогоном под tracemalloc (сверх того, что было занято до этапа). Результат можно
+сохранить как эталон и сравнивать с ним следующие запуски:
+
+    python noshow_bench.py --sizes 10k,100k,1m --save-baseline
+    python noshow_bench.py --sizes 10k,100k,1m          # код возврата 1 при регрессии
+
+Вместе с замерами сохраняется вариант файлов (кодировка, Den Brd, доля битых строк,
+число рейсов): размеры, эталон которых снят на другом варианте, не сравниваются,
+а если сравнить не с чем совсем, код возврата 2.
+
+С --check-formats вместо замеров проверяется, что одни и те же строки разбираются
+одинаково во всех вариантах выгрузки (кодировки с BOM и без, с шапкой и без,
+рейсы не N4-, переименованные колонки), и в памяти, и потоково, а выгрузка без
+заголовка таблицы не роняет разбор:
+
+    python noshow_bench.py --check-formats
+
+Разбор в памяти требует примерно в пять раз больше памяти, чем весит файл, поэтому
+на 10m (около 600 МБ) лучше запускать на машине с запасом памяти.
+"""
+import argparse
+from collections import defaultdict
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+from noshow_engine import StageTimer, build_summary_table, parse_flights_file, stream_flights_file
+from noshow_synth import generate_export, parse_rows
+
+
+STAGES = ['decode', 'header', 'parse', 'aggregate', 'index', 'build', 'window', 'summary']
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'noshow_bench_baseline.json')
+
+# Насколько (в долях) этап может стать медленнее или прожорливее эталона, прежде чем это считается регрессией
+DEFAULT_TOLERANCE = 0.25
+
+# Этапы быстрее этого порога (секунды) по времени не сравниваем — там один шум
+MIN_COMPARABLE_SECONDS = 0.05
+
+
+def _window_and_summary(dataset, timer):
+    """Этапы поверх готового датасета: окно дат с затуханием и сводная таблица."""
+    with timer.stage('window'):
+        first, last = dataset['date_range']
+        dataset['date_index'].window(first + (last - first) / 4, last, half_life=180)
+    with timer.stage('summary'):
+        build_summary_table(dataset['day_stats'], sorted(dataset['day_stats']), dataset['flight_segments'],
+                            dataset['has_den_brd'])
+
+
+def _run_pipeline(raw_bytes):
+    """parse_flights_file и этапы поверх него; [замеры StageTimer] в порядке выполнения и число записей."""
+    dataset = parse_flights_file(raw_bytes)
+    if dataset['error'] or not dataset['total_rows']:
+        raise ValueError(dataset['error'] or "в файле нет ни одной строки рейса")
+    timer = StageTimer()
+    _window_and_summary(dataset, timer)
+    return dataset['stages'] + timer.report(), dataset['total_rows']
+
+
+def measure_file(path, repeat=3, streaming=False):
+    """Время и пик памяти каждого этапа для одного файла: {этап: {'seconds', 'peak_mb', 'rows_per_s'}}."""
+    with open(path, 'rb') as f:
+        raw_bytes = f.read()
+
+    seconds = defaultdict(lambda: float('inf'))
+    for _ in range(repeat):
+        stages, rows = _run_pipeline(raw_bytes)
+        for entry in stages:
+            seconds[entry['stage']] = min(seconds[entry['stage']], entry['seconds'])
+
+    # под tracemalloc StageTimer сам записывает пик каждого этапа (сверх занятого до него)
+    StageTimer.start_tracing()
+    try:
+        stages, _ = _run_pipeline(raw_bytes)
+    finally:
+        StageTimer.stop_tracing()
+    peaks = {entry['stage']: entry['peak_mb'] or 0.0 for entry in stages}
+    del raw_bytes
+
+    names = [name for name in STAGES if name in seconds]
+    results = {name: {'seconds': seconds[name], 'peak_mb': peaks.get(name, 0.0),
+                      'rows_per_s': rows / seconds[name] if seconds[name] else None}
+               for name in names}
+    total = sum(seconds[name] for name in names)
+    results['total'] = {'seconds': total, 'peak_mb': max(peaks.values()), 'rows_per_s': rows / total}
+
+    if streaming:
+        # потоковый разбор целиком — одним этапом, он не делится на те же шаги
+        best = float('inf')
+        for _ in range(repeat):
+            with open(path, 'rb') as f:
+                started = time.perf_counter()
+                stream_flights_file(f)
+                best = min(best, time.perf_counter() - started)
+        tracemalloc.start()
+        try:
+            with open(path, 'rb') as f:
+                stream_flights_file(f)
+            peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+        results['stream'] = {'seconds': best, 'peak_mb': peak, 'rows_per_s': rows / best}
+
+    return rows, results
+
+
+# Варианты выгрузки для --check-formats: имя -> параметры generate_export
+FORMAT_VARIANTS = {
+    'windows-1251': {},
+    'utf-8-sig': {'encoding': 'utf-8-sig'},
+    'utf-8 без BOM': {'encoding': 'utf-8'},
+    'utf-8 без BOM и шапки': {'encoding': 'utf-8', 'preamble': False},
+    'utf-8, рейсы не N4-': {'encoding': 'utf-8', 'flight_prefix': 'XY-'},
+    'utf-8-sig, рейсы не N4-': {'encoding': 'utf-8-sig', 'flight_prefix': 'XY-'},
+    'windows-1251, рейсы не N4-': {'flight_prefix': 'XY-'},
+    'windows-1251, переименованы колонки вне разбора': {'rename': {'Тип ВС': 'Тип судна', 'Load': 'Загрузка'}},
+    'windows-1251 без заголовка таблицы': {'header': False},
+    'utf-8, заголовок по-английски': {'encoding': 'utf-8', 'rename': {'Рейс': 'Flight', 'Дата': 'Date'}},
+}
+
+# Варианты, в которых строки рейсов найти нельзя: ждём ни одной записи (или ошибку), но не исключение,
+# а все rows строк данных — в пропущенных
+NO_DATA_VARIANTS = {'windows-1251 без заголовка таблицы', 'utf-8, заголовок по-английски'}
+
+
+def check_formats(workdir, rows=5_000):
+    """Разбирает одни и те же строки во всех FORMAT_VARIANTS; список расхождений с вариантом windows-1251."""
+    problems = []
+    reference = None
+    for number, (name, options) in enumerate(FORMAT_VARIANTS.items()):
+        path = os.path.join(workdir, f"format_check_{number}.csv")
+        generate_export(path, rows, **options)
+        with open(path, 'rb') as f:
+            raw_bytes = f.read()
+        for mode, dataset in (('в памяти', parse_flights_file(raw_bytes)),
+                              ('потоково', stream_flights_file(io.BytesIO(raw_bytes), chunk_bytes=64 * 1024))):
+            if name in NO_DATA_VARIANTS:
+                if dataset['error']:
+                    continue
+                if dataset['total_rows']:
+                    problems.append(f"{name} ({mode}): {dataset['total_rows']} записей, ожидалось ни одной")
+                if dataset['skipped_rows'] != rows:
+                    problems.append(f"{name} ({mode}): пропущено {dataset['skipped_rows']} строк, ожидалось {rows}")
+                continue
+            if dataset['error']:
+                problems.append(f"{name} ({mode}): {dataset['error']}")
+                continue
+            counts = (dataset['total_rows'], dataset['skipped_rows'], len(dataset['all_flights']))
+            if reference is None:
+                reference = counts
+            elif counts != reference:
+                problems.append(f"{name} ({mode}): записей, пропущено, рейсов = {counts}, ожидалось {reference}")
+        os.remove(path)
+    return problems
+
+
+def compare(results, baseline, tolerance):
+    """(регрессии, размеры без сравнения): этапы, которые медленнее или прожорливее эталона больше чем на tolerance.
+
+    Размер сравнивается, только если эталон для него снят на том же варианте файлов;
+    остальные возвращаются вторым списком с объяснением.
+    """
+    regressions, skipped = [], []
+    for size, stages in results.items():
+        measured = baseline.get('sizes', {}).get(size)
+        if not measured:
+            skipped.append(f"{size}: в эталоне нет такого размера")
+            continue
+        if measured.get('variant') != stages['variant']:
+            skipped.append(f"{size}: эталон снят на варианте {measured.get('variant')}, сейчас {stages['variant']}")
+            continue
+        for stage, current in stages['stages'].items():
+            reference = measured['stages'].get(stage)
+            if not reference:
+                continue
+            if (reference['seconds'] >= MIN_COMPARABLE_SECONDS
+                    and current['seconds'] > reference['seconds'] * (1 + tolerance)):
+                regressions.append(f"{size} {stage}: время {current['seconds']:.3f} с "
+                                   f"(эталон {reference['seconds']:.3f} с, +{current['seconds'] / reference['seconds'] - 1:.0%})")
+            if reference['peak_mb'] >= 1 and current['peak_mb'] > reference['peak_mb'] * (1 + tolerance):
+                regressions.append(f"{size} {stage}: память {current['peak_mb']:.1f} МБ "
+                                   f"(эталон {reference['peak_mb']:.1f} МБ, +{current['peak_mb'] / reference['peak_mb'] - 1:.0%})")
+    return regressions, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора выгрузок по этапам.")
+    parser.add_argument('--sizes', default='10k,100k,1m',
+                        help="размеры файлов через запятую (10k ... 10m), по умолчанию 10k,100k,1m")
+    parser.add_argument('--workdir', default='noshow_bench_data',
+                        help="где хранить сгенерированные файлы (создаются один раз и переиспользуются)")
+    parser.add_argument('--encoding', choices=['windows-1251', 'utf-8-sig', 'utf-8'], default='windows-1251')
+    parser.add_argument('--no-den-brd', action='store_true', help="файлы без колонки Den Brd")
+    parser.add_argument('--malformed', type=float, default=0.005, help="доля битых строк")
+    parser.add_argument('--flights', type=int, default=150, help="число рейсов в файлах")
+    parser.add_argument('--repeat', type=int, default=3, help="прогонов на замер времени (берётся лучший)")
+    parser.add_argument('--streaming', action='store_true', help="дополнительно замерить потоковый разбор")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="файл эталона")
+    parser.add_argument('--save-baseline', action='store_true', help="записать результат как новый эталон")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="допустимое ухудшение в долях (по умолчанию 0.25)")
+    parser.add_argument('--json', help="сохранить результат в JSON")
+    parser.add_argument('--check-formats', action='store_true',
+                        help="не замерять, а проверить разбор всех вариантов выгрузки (код возврата 1 при ошибке)")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    if args.check_formats:
+        problems = check_formats(args.workdir)
+        for line in problems:
+            print(f"  {line}")
+        print("Все варианты выгрузки разбираются одинаково" if not problems else "Есть расхождения")
+        return 1 if problems else 0
+    results = {}
+    # с чем сравнимы замеры: эталон, снятый на других файлах, к ним не применим
+    variant = {'encoding': args.encoding, 'den_brd': not args.no_den_brd, 'malformed': args.malformed,
+               'flights': args.flights}
+    for size in args.sizes.split(','):
+        rows = parse_rows(size)
+        suffix = f"{args.encoding}{'_noden' if args.no_den_brd else ''}_m{args.malformed:g}_f{args.flights}"
+        path = os.path.join(args.workdir, f"export_{size.strip().lower()}_{suffix}.csv")
+        if not os.path.exists(path):
+            print(f"Генерируем {path} ...", file=sys.stderr)
+            generate_export(path, rows, flights=args.flights, encoding=args.encoding, den_brd=not args.no_den_brd,
+                            malformed=args.malformed)
+
+        parsed_rows, stages = measure_file(path, repeat=args.repeat, streaming=args.streaming)
+        results[size.strip().lower()] = {'rows': parsed_rows, 'bytes': os.path.getsize(path), 'variant': variant,
+                                         'stages': stages}
+
+        print(f"\n{size}: {parsed_rows} записей, {os.path.getsize(path) / 2 ** 20:.1f} МБ")
+        print(f"  {'этап':<10} {'время, с':>10} {'пик, МБ':>10} {'строк/с':>12}")
+        for stage, measured in stages.items():
+            print(f"  {stage:<10} {measured['seconds']:>10.4f} {measured['peak_mb']:>10.1f} "
+                  f"{measured['rows_per_s'] or 0:>12,.0f}")
+
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'sizes': results}
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nЭталон записан в {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nЭталона {args.baseline} нет — сравнивать не с чем (запустите с --save-baseline)")
+        return 0
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions, skipped = compare(results, baseline, args.tolerance)
+    if skipped:
+        print("\nНе сравниваются с эталоном:")
+        for line in skipped:
+            print(f"  {line}")
+        if len(skipped) == len(results):
+            print("Сравнивать не с чем: запустите с теми же параметрами, что эталон, или снимите эталон заново")
+            return 2
+    if regressions:
+        print("\nРегрессии относительно эталона:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("\nРегрессий относительно эталона нет")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1760 @@
+"""Расчёт NoShow по выгрузкам Leonardo без Streamlit: разбор файлов, статистика, история и прогноз.
+
+Используется интерфейсом (app.py) и ночным пакетным запуском (noshow_batch.py).
+"""
+import pandas as pd
+from pandas.api.types import union_categoricals
+import numpy as np
+import codecs
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import csv
+from datetime import date, datetime, timedelta
+from collections import defaultdict, Counter, OrderedDict
+from contextlib import closing, contextmanager
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+
+try:
+    import resource
+except ImportError:  # Windows: пик RSS по этапам не меряется
+    resource = None
+
+
+ENCODINGS_TO_TRY = ['utf-8-sig', 'windows-1251', 'cp1251', 'iso-8859-1', 'utf-8']
+
+HEADER_MARKER = 'Рейс;Дата;Частота;Сегмент;'
+
+# строка данных — та, где больше 5 разделителей ';', т.е. минимум 7 полей
+MIN_DATA_FIELDS = 7
+
+DAYS_ORDER = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Порог, ниже которого выборка считается ненадёжной
+MIN_RELIABLE_SAMPLES = 5
+
+# колонка выгрузки -> имя числовой колонки в records
+NUMERIC_COLUMNS = {'Seg Bkd Total': 'bkd', 'Nsh': 'nsh', 'Den Brd': 'den_brd'}
+# числа, которые float() понимает в выгрузках: '12', '-3.5', '.5', '1e2' (inf/nan всё равно отбрасываются)
+NUMBER_PATTERN = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+
+# По стольким первым байтам угадывается кодировка (весь файл перепроверяется, только если дальше она не подойдёт)
+ENCODING_SNIFF_BYTES = 1024 * 1024
+
+# Файлы больше этого размера разбираются потоково (stream_flights_file), кусками по STREAM_CHUNK_BYTES
+STREAMING_THRESHOLD_BYTES = 200 * 1024 * 1024
+STREAM_CHUNK_BYTES = 8 * 1024 * 1024
+
+# Сколько процессов разбирают несколько выгрузок одновременно (parse_flights_files)
+PARSE_WORKERS = os.cpu_count() or 1
+
+# Локальная история выгрузок (SQLite); каталог можно переопределить переменной окружения NOSHOW_HISTORY_DIR
+HISTORY_DIR = os.environ.get('NOSHOW_HISTORY_DIR',
+                             os.path.join(os.path.dirname(os.path.abspath(__file__)), 'noshow_history'))
+HISTORY_DB_NAME = 'history.sqlite3'
+
+# Сколько памяти держит общий для всех сессий кэш разобранных выгрузок (DatasetCache), байт;
+# переопределяется переменной окружения NOSHOW_CACHE_MB (в мегабайтах)
+DATASET_CACHE_BYTES = int(os.environ.get('NOSHOW_CACHE_MB', 1024)) * 1024 * 1024
+
+# До стольких наблюдений на (рейс, день недели) потоковая медиана точная, дальше — с шагом MEDIAN_RESOLUTION
+MEDIAN_EXACT_LIMIT = 4096
+MEDIAN_RESOLUTION = 1e-4
+
+# Шаг гистограммы per-flight rate в истории: не больше 1 / шаг + 1 корзин на (рейс, день недели)
+# при любой глубине истории; noshow в моделировании смещается не больше чем на шаг / 2 × бронирования
+HISTORY_RATE_RESOLUTION = 1e-3
+
+# Структурированные строки диагностики (по одной JSON-строке на этап) пишутся в этот логгер
+logger = logging.getLogger('noshow')
+
+
+class StageTimer:
+    """Время, пик памяти и число строк по этапам разбора и отрисовки.
+
+    Время меряется всегда (это дёшево), как и rss_peak_mb — пик RSS всего процесса
+    к концу этапа (resource.getrusage; None, где модуля resource нет). Пик памяти самого
+    этапа (peak_mb) — только пока поток, в котором он идёт, держит трассировку
+    tracemalloc (start_tracing), иначе None: счётчик пика у tracemalloc один на процесс,
+    и сбрасывать его из чужих сессий нельзя. Этапы можно вкладывать друг в друга:
+    пик внутреннего этапа учитывается и во внешнем. Повторный вход в этап с тем же
+    именем (куски потокового разбора) складывает время и строки.
+    """
+
+    # открытые этапы текущего потока — у каждой сессии Streamlit свой поток
+    _open = threading.local()
+    # поток, который включил tracemalloc через start_tracing (только он меряет и сбрасывает пик)
+    _tracing_thread = None
+    _tracing_lock = threading.Lock()
+
+    def __init__(self):
+        self.stages = {}
+
+    @classmethod
+    def start_tracing(cls):
+        """Включает tracemalloc для пиков по этапам текущего потока; False, если трассировка уже идёт."""
+        with cls._tracing_lock:
+            if tracemalloc.is_tracing():
+                return False
+            tracemalloc.start()
+            cls._tracing_thread = threading.get_ident()
+            return True
+
+    @classmethod
+    def stop_tracing(cls):
+        """Выключает трассировку, включённую start_tracing в этом же потоке."""
+        with cls._tracing_lock:
+            if cls._tracing_thread == threading.get_ident():
+                cls._tracing_thread = None
+                tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        entry = self.stages.setdefault(name, {'stage': name, 'seconds': 0.0, 'peak_mb': None, 'rss_peak_mb': None,
+                                              'rows': None})
+        if not hasattr(self._open, 'stages'):
+            self._open.stages = []
+        open_stages = self._open.stages
+        tracing = self._tracing_thread == threading.get_ident() and tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            self._fold_peak(open_stages, peak)
+            tracemalloc.reset_peak()
+            open_stages.append((entry, current))
+        started = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] += time.perf_counter() - started
+            if rows is not None:
+                entry['rows'] = (entry['rows'] or 0) + rows
+            if resource is not None:
+                entry['rss_peak_mb'] = _max_rss_mb()
+            if tracing and tracemalloc.is_tracing():
+                self._fold_peak(open_stages, tracemalloc.get_traced_memory()[1])
+                open_stages.pop()
+
+    @staticmethod
+    def _fold_peak(open_stages, peak):
+        for entry, baseline in open_stages:
+            entry['peak_mb'] = max(entry['peak_mb'] or 0.0, (peak - baseline) / 2 ** 20)
+
+    def report(self):
+        """Список этапов в порядке выполнения: stage, seconds, peak_mb, rows, rows_per_s."""
+        return [dict(entry, rows_per_s=entry['rows'] / entry['seconds'] if entry['rows'] and entry['seconds'] else None)
+                for entry in self.stages.values()]
+
+
+def _max_rss_mb():
+    """Пик RSS процесса с его запуска, МБ (ru_maxrss — в КБ, на macOS — в байтах)."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 2 ** 20 if sys.platform == 'darwin' else max_rss / 2 ** 10
+
+
+def log_stages(stages, **context):
+    """Пишет этапы в логгер noshow структурированными строками: одна JSON-строка на этап."""
+    for entry in stages:
+        logger.info(json.dumps(dict(context, **entry), ensure_ascii=False, default=str))
+
+
+def detect_encoding(raw_bytes):
+    """Первая кодировка из ENCODINGS_TO_TRY, в которой файл читается без ошибок, или None."""
+    for encoding in ENCODINGS_TO_TRY:
+        try:
+            raw_bytes.decode(encoding)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def find_data_start(raw_bytes, encoding):
+    """Смещение (в байтах) начала строки заголовка таблицы Leonardo или -1, если таблица не найдена."""
+    # у utf-8-sig encode() дописывает BOM в начало маркера — ищем без него
+    codec = 'utf-8' if codecs.lookup(encoding).name == 'utf-8-sig' else encoding
+    try:
+        position = raw_bytes.find(HEADER_MARKER.encode(codec))
+    except UnicodeEncodeError:
+        position = -1
+    if position >= 0:
+        return raw_bytes.rfind(b'\n', 0, position) + 1
+
+    # заголовок могли переименовать — ищем первую строку рейса N4- и берём строку над ней
+    for match in re.finditer(rb'^N4-[^\n]*', raw_bytes, re.MULTILINE):
+        if match.group().count(b';') > 10:
+            if match.start() == 0:
+                return -1
+            return raw_bytes.rfind(b'\n', 0, match.start() - 1) + 1
+    return -1
+
+
+def select_data_lines(data_bytes):
+    """Оставляет только строки данных (минимум MIN_DATA_FIELDS полей) и считает наибольшую ширину.
+
+    Работает прямо по байтам: ';' и перевод строки однобайтовые во всех кодировках из
+    ENCODINGS_TO_TRY, так что резать текст на строки в Python не нужно.
+    Возвращает (байты отобранных строк, число полей в самой длинной из них). Строки с
+    кавычками пересчитываются csv-разбором: ';' внутри кавычек полем не считается.
+    """
+    buffer = np.frombuffer(data_bytes, dtype=np.uint8)
+    line_starts = np.concatenate(([0], np.flatnonzero(buffer == ord('\n')) + 1))
+    line_ends = np.append(line_starts[1:], len(buffer))
+    semicolons = np.flatnonzero(buffer == ord(';'))
+    per_line = np.searchsorted(semicolons, line_ends) - np.searchsorted(semicolons, line_starts)
+
+    keep = per_line >= MIN_DATA_FIELDS - 1
+    if not keep.any():
+        return b'', 0
+    fields = per_line + 1
+    quoted = np.zeros(len(line_starts), dtype=bool)
+    quoted[np.searchsorted(line_starts, np.flatnonzero(buffer == ord('"')), side='right') - 1] = True
+    for line in np.flatnonzero(quoted & keep):
+        # latin-1 обратима для любых байтов, а ';' и '"' в ней те же, что во всех ENCODINGS_TO_TRY
+        text = data_bytes[line_starts[line]:line_ends[line]].decode('latin-1').rstrip('\r\n')
+        fields[line] = max((len(row) for row in csv.reader([text], delimiter=';')), default=1)
+    width = int(fields[keep].max())
+    if keep.all():
+        return data_bytes, width
+    return buffer[np.repeat(keep, line_ends - line_starts)].tobytes(), width
+
+
+def _column(table, name, default=''):
+    """Колонка выгрузки; отсутствующая колонка считается пустой."""
+    if name in table.columns:
+        return table[name]
+    return pd.Series(default, index=table.index, dtype=object)
+
+
+def _to_int_column(values):
+    """int(float(x)) для всей колонки сразу: пустое значение = 0, нечисловое = NaN (строка будет пропущена)."""
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.fillna(0).astype('float64')
+    else:
+        # в колонке попался мусор — парсер оставил её строковой (или смешанной по блокам);
+        # нечисловое отсеивается одним регулярным выражением, остальное приводится к float разом
+        values = values.fillna('').astype(str).str.strip()
+        values = values.mask(values == '', '0')
+        values = values.where(values.str.fullmatch(NUMBER_PATTERN)).astype('float64')
+    return np.trunc(values.where(np.isfinite(values)))
+
+
+def _parse_dates(values):
+    """Разбор дат '%d.%m.%Y'; каждая уникальная дата разбирается один раз, а не на каждой строке."""
+    codes, uniques = pd.factorize(values)
+    parsed = pd.to_datetime(pd.Series(uniques, dtype=object), format='%d.%m.%Y', errors='coerce')
+    return pd.Series(parsed.to_numpy()[codes], index=values.index)
+
+
+def _read_records(data_bytes, header, width, encoding, strict=False):
+    """Читает блок строк данных (уже отобранных select_data_lines) в типизированные колонки.
+
+    Возвращает (records, skipped_rows, has_dated_rows): has_dated_rows — была ли хоть одна
+    строка с рейсом и датой, от этого зависит has_den_brd. strict=True — байты, не
+    подходящие к encoding, не заменяются, а поднимают UnicodeDecodeError.
+    """
+    # Имена колонок как у csv.DictReader: при повторе побеждает последняя колонка,
+    # лишние поля в конце строки получают служебные имена и не читаются
+    names = [name if name not in header[i + 1:] else f'{name}__dup{i}' for i, name in enumerate(header)]
+    names += [f'__extra{i}' for i in range(width - len(names))]
+    text_columns = [name for name in ('Рейс', 'Дата', 'Сегмент') if name in names]
+    numeric_columns = [name for name in NUMERIC_COLUMNS if name in names]
+
+    def read_table(usecols):
+        # числа разбирает C-парсер; пустая ячейка -> NaN (потом 0), а колонка с мусором остаётся строковой
+        return pd.read_csv(io.BytesIO(data_bytes), sep=';', header=None, names=names, usecols=usecols,
+                           encoding=encoding, encoding_errors='strict' if strict else 'replace',
+                           dtype={name: str for name in text_columns}, keep_default_na=False,
+                           na_values={name: [''] for name in numeric_columns}, on_bad_lines='warn')
+
+    # Строки, которые нельзя разбить как CSV, парсер пропускает с предупреждением — считаем их по предупреждениям
+    with warnings.catch_warnings(record=True) as parser_warnings:
+        warnings.simplefilter('always', pd.errors.ParserWarning)
+        try:
+            # без единой знакомой колонки всё равно читаем первую: иначе парсер вернёт 0 строк,
+            # а все строки данных должны попасть в пропущенные
+            table = read_table(text_columns + numeric_columns or names[:1])
+        except pd.errors.ParserError:
+            # width (select_data_lines) уже учитывает кавычки, так что сюда попадают только строки,
+            # которые C-парсер режет иначе, чем csv, — лишних имён при usecols он не принимает
+            table = read_table(None)
+    skipped_rows = sum(str(w.message).count('Skipping line') for w in parser_warnings)
+
+    # пропуски в текстовых колонках (NaN) считаем пустой строкой
+    flight = _column(table, 'Рейс').fillna('').str.strip()
+    dates = _parse_dates(_column(table, 'Дата').fillna(''))
+    numbers = {key: _to_int_column(_column(table, name, default=0)) for name, key in NUMERIC_COLUMNS.items()}
+
+    has_date = (flight != '') & dates.notna()
+    valid = has_date & numbers['bkd'].notna() & numbers['nsh'].notna() & numbers['den_brd'].notna()
+    skipped_rows += int((~valid).sum())
+
+    valid_dates = dates[valid]
+    records = pd.DataFrame({
+        'flight': flight[valid],
+        'date': valid_dates,
+        'weekday': valid_dates.dt.weekday.astype('int8'),
+        'segment': _column(table, 'Сегмент').fillna('')[valid].str.strip(),
+        **{key: column[valid].astype('int64') for key, column in numbers.items()},
+    }).reset_index(drop=True)
+    return records, skipped_rows, bool(has_date.any())
+
+
+def count_segments(records, flight_segments):
+    """Добавляет частоты сегментов из records в flight_segments ({рейс: Counter})."""
+    # sort=False сохраняет порядок первого появления — от него зависят most_common() при равных
+    # частотах, как было при построчном разборе
+    segment_counts = records[records['segment'] != ''].groupby(['flight', 'segment'], sort=False,
+                                                                observed=True).size()
+    for (flight_number, segment), count in segment_counts.items():
+        flight_segments[flight_number][segment] += count
+
+
+def _per_flight_rates(records):
+    """nsh / bkd по каждой строке (0, если бронирований не было)."""
+    bkd = records['bkd'].to_numpy()
+    return np.divide(records['nsh'].to_numpy(), bkd, out=np.zeros(len(records)), where=bkd > 0)
+
+
+def _finish_group_stats(stats):
+    """Достраивает производные колонки по суммам и количеству наблюдений в группе."""
+    total_bkd = stats['total_bkd'].to_numpy()
+    stats['rate'] = np.divide(stats['total_nsh'].to_numpy(), total_bkd, out=np.zeros(len(stats)), where=total_bkd > 0)
+    stats['avg_bookings'] = stats['total_bkd'] // stats['count']
+    stats['den_brd_share'] = stats['flights_with_den_brd'] / stats['count']
+    stats['reliable'] = stats['count'] >= MIN_RELIABLE_SAMPLES
+    return stats
+
+
+def compute_group_stats(records):
+    """Статистика по всем парам (рейс, день недели) за один проход группировки.
+
+    Считает rate, медиану и std per-flight rate, среднее bkd, кол-во наблюдений и Den Brd
+    статистику. Возвращает DataFrame с индексом (flight, weekday) в порядке первого появления.
+    """
+    # per-flight rate для std (а не общий rate) — чтобы видеть разброс между датами
+    grouped = records.assign(per_flight_rate=_per_flight_rates(records), had_den_brd=records['den_brd'] > 0).groupby(
+        ['flight', 'weekday'], sort=False)
+    stats = grouped.agg(
+        total_bkd=('bkd', 'sum'),
+        total_nsh=('nsh', 'sum'),
+        total_den_brd=('den_brd', 'sum'),
+        flights_with_den_brd=('had_den_brd', 'sum'),
+        count=('bkd', 'size'),
+        rate_median=('per_flight_rate', 'median'),
+    )
+    stats['rate_std'] = grouped['per_flight_rate'].std(ddof=0).fillna(0.0)
+    return _finish_group_stats(stats)
+
+
+def day_stats_by_flight(stats):
+    """Раскладывает результат compute_group_stats в {рейс: {день недели: словарь статистики}} для интерфейса."""
+    day_stats = defaultdict(dict)
+    for (flight, weekday), row in zip(stats.index, stats.to_dict('records')):
+        day_stats[flight][DAYS_ORDER[weekday]] = row
+    return dict(day_stats)
+
+
+def rate_distributions(records, resolution=None):
+    """Распределение per-flight rate по каждой паре (рейс, день недели): {(рейс, день): (значения, частоты)}.
+
+    По нему моделируются исходы в noshow_simulation; одинаковые rate хранятся один раз с частотой.
+    С resolution rate сводятся в корзины такой ширины (значение корзины — среднее попавших
+    в неё rate), и на пару приходится не больше 1 / resolution + 1 значений.
+    """
+    rates = _per_flight_rates(records)
+    if resolution is not None:
+        counts = records.assign(rate=rates, bin=np.rint(rates / resolution)).groupby(
+            ['flight', 'weekday', 'bin'], sort=False).agg(rate=('rate', 'mean'), count=('rate', 'size')).reset_index()
+    else:
+        counts = records.assign(rate=rates).groupby(
+            ['flight', 'weekday', 'rate'], sort=False).size().reset_index(name='count')
+    return {key: (group['rate'].to_numpy(), group['count'].to_numpy())
+            for key, group in counts.groupby(['flight', 'weekday'], sort=False)}
+
+
+def _build_dataset(records, group_stats, distributions, flight_segments, has_den_brd, total_rows, skipped_rows,
+                   date_index=None, date_range=None):
+    """Собирает словарь, который отдают parse_flights_file и stream_flights_file.
+
+    date_range — границы дат, если date_index не строился (иначе они берутся из индекса).
+    """
+    day_stats = day_stats_by_flight(group_stats)
+    return {
+        # строки по датам (CompactRecords, под date_index) или None, если они не сохранялись
+        'records': records,
+        'group_stats': group_stats,
+        'rate_distributions': distributions,
+        # DateIndex для окна дат и затухания (dataset_window); None — если строки по датам не сохранялись
+        'date_index': date_index,
+        # первая и последняя дата данных (datetime.date) — границы выбора периода; None, если строк нет
+        'date_range': (date_index.first_date, date_index.last_date) if date_index is not None and len(date_index)
+        else date_range,
+        # обычные dict вместо defaultdict: результат общий для всех сессий и не должен дорастать при чтении
+        'day_stats': day_stats,
+        'all_flights': set(day_stats),
+        'flight_segments': dict(flight_segments),
+        'has_den_brd': has_den_brd,
+        'total_rows': total_rows,
+        'skipped_rows': skipped_rows,
+        'error': None,
+    }
+
+
+def parse_flights_file(raw_bytes, date_index=True):
+    """Разбирает выгрузку Leonardo в структуры, с которыми работает интерфейс.
+
+    Таблица читается целиком в типизированные колонки (flight, date, weekday,
+    segment, bkd, nsh, den_brd) без словаря на строку, статистика по дням недели
+    считается сразу для всех рейсов. Возвращает словарь с ключами records,
+    group_stats, rate_distributions, date_index, day_stats, all_flights,
+    flight_segments, has_den_brd, total_rows, skipped_rows, stages (замеры
+    StageTimer) и error (текст ошибки или None). Строки остаются в памяти только
+    в виде CompactRecords (records) под DateIndex; date_index=False не собирает ни
+    то ни другое (records = None).
+    """
+    timer = StageTimer()
+    parsed = _parse_records(raw_bytes, timer)
+    if isinstance(parsed, str):
+        return {'error': parsed}
+    records, skipped_rows, has_den_brd = parsed
+
+    with timer.stage('aggregate', rows=len(records)):
+        flight_segments = defaultdict(Counter)
+        count_segments(records, flight_segments)
+        group_stats = compute_group_stats(records)
+        distributions = rate_distributions(records)
+
+    total_rows, index = len(records), None
+    if date_index:
+        with timer.stage('index', rows=total_rows):
+            index = DateIndex(CompactRecords(compact_rows(records)))
+    del records
+
+    with timer.stage('build'):
+        dataset = _build_dataset(index.records if index is not None else None, group_stats, distributions,
+                                 flight_segments, has_den_brd, total_rows=total_rows, skipped_rows=skipped_rows,
+                                 date_index=index)
+    dataset['stages'] = timer.report()
+    return dataset
+
+
+def _parse_records(raw_bytes, timer, encoding=None):
+    """Этапы decode, header и parse: (records, skipped_rows, has_den_brd) или текст ошибки.
+
+    Кодировка угадывается по первым ENCODING_SNIFF_BYTES, а строки читаются строго в ней.
+    Если дальше в файле встретятся неподходящие байты, кодировка определяется по всему
+    файлу (detect_encoding) и разбор повторяется — так же, как раньше выбиралась сразу.
+    """
+    strict = encoding is None
+    if strict:
+        with timer.stage('decode'):
+            encoding = sniff_encoding(raw_bytes[:ENCODING_SNIFF_BYTES]) or 'utf-8'
+
+    with timer.stage('header'):
+        header_start = find_data_start(raw_bytes, encoding)
+        header_end = raw_bytes.find(b'\n', header_start) if header_start >= 0 else -1
+    if header_end < 0:
+        return "❌ Не удалось найти данные в файле"
+
+    with timer.stage('parse') as parse_stage:
+        data_bytes, width = select_data_lines(raw_bytes[header_end + 1:])
+        if not data_bytes:
+            return "❌ Не найдено данных в файле"
+
+        header = _parse_header(raw_bytes[header_start:header_end], encoding)
+        try:
+            records, skipped_rows, has_dated_rows = _read_records(data_bytes, header, width, encoding, strict=strict)
+        except UnicodeDecodeError:
+            records = None
+        if records is not None:
+            parse_stage['rows'] = len(records)
+    if records is None:
+        with timer.stage('decode'):
+            # ни одна кодировка не подошла — читаем как utf-8, заменяя битые символы
+            encoding = detect_encoding(raw_bytes) or 'utf-8'
+        return _parse_records(raw_bytes, timer, encoding)
+    return records, skipped_rows, 'Den Brd' in header and has_dated_rows
+
+
+def _parse_header(header_bytes, encoding):
+    """Список имён колонок из строки заголовка."""
+    return next(csv.reader([header_bytes.decode(encoding, errors='replace').strip()], delimiter=';'))
+
+
+class RateSketch:
+    """Сливаемый скетч для медианы per-flight rate в потоковом режиме.
+
+    Пока значений не больше exact_limit, хранит их как есть, и медиана точная.
+    Дальше сворачивается в гистограмму с шагом resolution: память ограничена
+    числом корзин, а медиана получается с точностью до шага.
+    """
+
+    def __init__(self, exact_limit=MEDIAN_EXACT_LIMIT, resolution=MEDIAN_RESOLUTION):
+        self.exact_limit = exact_limit
+        self.resolution = resolution
+        self.values = np.empty(0)
+        self.bins = None  # Counter: номер корзины -> количество значений
+
+    def add(self, values):
+        if self.bins is not None:
+            self._add_to_bins(values)
+            return
+        self.values = np.concatenate((self.values, values))
+        if len(self.values) > self.exact_limit:
+            self.bins = Counter()
+            self._add_to_bins(self.values)
+            self.values = np.empty(0)
+
+    def merge(self, other):
+        if other.bins is None:
+            self.add(other.values)
+            return
+        if self.bins is None:
+            values, self.values, self.bins = self.values, np.empty(0), Counter()
+            self._add_to_bins(values)
+        self.bins.update(other.bins)
+
+    def median(self):
+        """Медиана как у statistics.median: при чётном количестве — среднее двух средних значений."""
+        if self.bins is None:
+            return float(np.median(self.values)) if len(self.values) else 0.0
+        keys = np.array(sorted(self.bins))
+        positions = np.cumsum([self.bins[key] for key in keys])
+        total = positions[-1]
+        lower = keys[np.searchsorted(positions, (total - 1) // 2, side='right')]
+        upper = keys[np.searchsorted(positions, total // 2, side='right')]
+        return float((lower + upper) / 2 * self.resolution)
+
+    def distribution(self):
+        """(значения, частоты): точные значения или середины корзин, если скетч уже свёрнут."""
+        if self.bins is None:
+            return np.unique(self.values, return_counts=True)
+        keys = np.array(sorted(self.bins))
+        return keys * self.resolution, np.array([self.bins[key] for key in keys])
+
+    def _add_to_bins(self, values):
+        keys, counts = np.unique(np.rint(values / self.resolution).astype(np.int64), return_counts=True)
+        self.bins.update(dict(zip(keys.tolist(), counts.tolist())))
+
+
+def accumulate_group_stats(accumulators, records, exact_limit=MEDIAN_EXACT_LIMIT):
+    """Добавляет records в накопители {(рейс, день недели): суммы, моменты rate и RateSketch}.
+
+    В отличие от compute_group_stats, накопители можно пополнять кусками файла;
+    итоговую таблицу из них строит finalize_group_stats.
+    """
+    per_flight_rate = _per_flight_rates(records)
+    grouped = records.assign(per_flight_rate=per_flight_rate, had_den_brd=records['den_brd'] > 0).groupby(
+        ['flight', 'weekday'], sort=False)
+    partial = grouped.agg(
+        total_bkd=('bkd', 'sum'),
+        total_nsh=('nsh', 'sum'),
+        total_den_brd=('den_brd', 'sum'),
+        flights_with_den_brd=('had_den_brd', 'sum'),
+        count=('bkd', 'size'),
+        rate_mean=('per_flight_rate', 'mean'),
+    )
+    partial['rate_m2'] = grouped['per_flight_rate'].var(ddof=0) * partial['count']
+    positions = grouped.indices
+
+    for key, part in zip(partial.index, partial.to_dict('records')):
+        part['sketch'] = RateSketch(exact_limit)
+        part['sketch'].add(per_flight_rate[positions[key]])
+
+        current = accumulators.get(key)
+        if current is None:
+            accumulators[key] = part
+            continue
+
+        # среднее и сумма квадратов отклонений сливаются по формуле Чана
+        count = current['count'] + part['count']
+        delta = part['rate_mean'] - current['rate_mean']
+        current['rate_m2'] += part['rate_m2'] + delta * delta * current['count'] * part['count'] / count
+        current['rate_mean'] += delta * part['count'] / count
+        current['count'] = count
+        for column in ('total_bkd', 'total_nsh', 'total_den_brd', 'flights_with_den_brd'):
+            current[column] += part[column]
+        current['sketch'].merge(part['sketch'])
+
+
+def finalize_group_stats(accumulators):
+    """Таблица того же вида, что у compute_group_stats, из накопителей accumulate_group_stats."""
+    stats = pd.DataFrame(
+        [(acc['total_bkd'], acc['total_nsh'], acc['total_den_brd'], acc['flights_with_den_brd'], acc['count'],
+          acc['sketch'].median(), float(np.sqrt(max(acc['rate_m2'], 0.0) / acc['count'])))
+         for acc in accumulators.values()],
+        columns=['total_bkd', 'total_nsh', 'total_den_brd', 'flights_with_den_brd', 'count', 'rate_median', 'rate_std'],
+        index=pd.MultiIndex.from_tuples(list(accumulators), names=['flight', 'weekday']),
+    ).astype({'total_bkd': 'int64', 'total_nsh': 'int64', 'total_den_brd': 'int64', 'flights_with_den_brd': 'int64',
+              'count': 'int64', 'rate_median': 'float64', 'rate_std': 'float64'})
+    return _finish_group_stats(stats)
+
+
+def sniff_encoding(prefix):
+    """Кодировка по началу файла: как detect_encoding, но без требования, чтобы кусок кончался на целом символе."""
+    for encoding in ENCODINGS_TO_TRY:
+        try:
+            codecs.getincrementaldecoder(encoding)().decode(prefix, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def stream_flights_file(fileobj, chunk_bytes=STREAM_CHUNK_BYTES, exact_limit=MEDIAN_EXACT_LIMIT, on_records=None,
+                        date_index=True):
+    """Потоковый разбор выгрузки, которая не помещается в память целиком.
+
+    Кодировка определяется по первому куску, заголовок ищется по мере чтения, а строки
+    кусками по chunk_bytes сразу сворачиваются в накопители по (рейс, день недели).
+    Память зависит от числа групп, а не строк; медиана точная, пока в группе не больше
+    exact_limit наблюдений (см. RateSketch). Результат того же вида, что у
+    parse_flights_file; построчно хранятся только CompactRecords под DateIndex.
+
+    Отличия от parse_flights_file: байты, не подходящие к кодировке первого куска,
+    заменяются, а если строка рейса N4- встретится раньше заголовка, заголовком
+    считается строка над ней.
+
+    on_records, если задан, вызывается с records каждого куска — например, чтобы
+    сложить строки в историю, не держа весь файл в памяти.
+
+    date_index=False не собирает CompactRecords и DateIndex (records = None): они держат
+    по строке на дату, и тем, кому окно дат не нужно, эта память ни к чему. date_range
+    при этом всё равно заполняется, а индекс, если период всё-таки выберут, строит
+    stream_date_index.
+    """
+    timer = StageTimer()
+    with timer.stage('read'):
+        pending = fileobj.read(chunk_bytes)
+    with timer.stage('decode'):
+        encoding = sniff_encoding(pending) or 'utf-8'
+
+    # ищем заголовок только в полных строках; просмотренное без результата выбрасываем,
+    # оставляя последние две строки — вдруг следующая окажется первой строкой N4-
+    header_end = -1
+    with timer.stage('header'):
+        while True:
+            complete_end = pending.rfind(b'\n') + 1
+            header_start = find_data_start(pending[:complete_end], encoding)
+            if header_start >= 0:
+                header_end = pending.find(b'\n', header_start)
+                break
+            block = fileobj.read(chunk_bytes)
+            if not block:
+                break
+            keep_from = pending.rfind(b'\n', 0, max(pending.rfind(b'\n', 0, max(complete_end - 1, 0)), 0)) + 1
+            pending = pending[keep_from:] + block
+    if header_end < 0:
+        return {'error': "❌ Не удалось найти данные в файле"}
+
+    header = _parse_header(pending[header_start:header_end], encoding)
+    leftover = pending[header_end + 1:]
+    del pending
+
+    accumulators = {}
+    flight_segments = defaultdict(Counter)
+    index_rows = []
+    first_date = last_date = None
+    total_rows = skipped_rows = 0
+    has_dated_rows = found_data = False
+
+    while True:
+        with timer.stage('read'):
+            block = fileobj.read(chunk_bytes)
+        data = leftover + block
+        # кусок режем по последнему переводу строки, хвост уходит в следующий кусок
+        cut = data.rfind(b'\n') + 1 if block else len(data)
+        data, leftover = data[:cut], data[cut:]
+
+        with timer.stage('parse') as parse_stage:
+            data_bytes, width = select_data_lines(data)
+            if data_bytes:
+                records, skipped, dated = _read_records(data_bytes, header, width, encoding)
+                parse_stage['rows'] = (parse_stage['rows'] or 0) + len(records)
+        if data_bytes:
+            found_data = True
+            with timer.stage('aggregate', rows=len(records)):
+                count_segments(records, flight_segments)
+                accumulate_group_stats(accumulators, records, exact_limit)
+            if date_index:
+                with timer.stage('index', rows=len(records)):
+                    index_rows.append(compact_rows(records))
+            elif len(records):
+                # без индекса помним только границы дат — для выбора периода
+                chunk_first, chunk_last = records['date'].min().date(), records['date'].max().date()
+                first_date = chunk_first if first_date is None else min(first_date, chunk_first)
+                last_date = chunk_last if last_date is None else max(last_date, chunk_last)
+            if on_records is not None:
+                on_records(records)
+            total_rows += len(records)
+            skipped_rows += skipped
+            has_dated_rows = has_dated_rows or dated
+
+        if not block:
+            break
+
+    if not found_data:
+        return {'error': "❌ Не найдено данных в файле"}
+
+    index = None
+    if date_index:
+        with timer.stage('index', rows=total_rows):
+            index = DateIndex(CompactRecords(_concat_rows(index_rows)))
+            del index_rows
+
+    with timer.stage('build'):
+        distributions = {key: acc['sketch'].distribution() for key, acc in accumulators.items()}
+        dataset = _build_dataset(index.records if index is not None else None, finalize_group_stats(accumulators),
+                                 distributions, flight_segments,
+                                 has_den_brd='Den Brd' in header and has_dated_rows,
+                                 total_rows=total_rows, skipped_rows=skipped_rows, date_index=index,
+                                 date_range=(first_date, last_date) if first_date is not None else None)
+    dataset['stages'] = timer.report()
+    return dataset
+
+
+def stream_date_index(fileobj, chunk_bytes=STREAM_CHUNK_BYTES):
+    """DateIndex выгрузки, разобранной stream_flights_file(..., date_index=False), — для dataset_window.
+
+    Файл читается заново тем же потоковым разбором (его накопители при этом считаются
+    зря), зато строки по датам держит в памяти только тот, кто выбрал период.
+    None — если в файле не нашлось данных.
+    """
+    return stream_flights_file(fileobj, chunk_bytes=chunk_bytes).get('date_index')
+
+
+SUM_COLUMNS = ['total_bkd', 'total_nsh', 'total_den_brd', 'flights_with_den_brd', 'count']
+
+
+def _group_sums(records):
+    """Суммы по (рейс, день недели), распределение per-flight rate и частоты сегментов для partial_aggregates."""
+    frame = records.assign(rate=_per_flight_rates(records), had_den_brd=records['den_brd'] > 0)
+    # observed=True — для rows из partial_aggregates, где рейс и сегмент категории
+    sums = frame.groupby(['flight', 'weekday'], sort=False, observed=True).agg(
+        total_bkd=('bkd', 'sum'),
+        total_nsh=('nsh', 'sum'),
+        total_den_brd=('den_brd', 'sum'),
+        flights_with_den_brd=('had_den_brd', 'sum'),
+        count=('bkd', 'size'),
+    )
+    rates = frame.groupby(['flight', 'weekday', 'rate'], sort=False, observed=True).size()
+    flight_segments = defaultdict(Counter)
+    count_segments(records, flight_segments)
+    return sums, rates, flight_segments
+
+
+def partial_aggregates(records):
+    """Частичные агрегаты выгрузки (или её куска), которые складываются с агрегатами других файлов.
+
+    Словарь с ключами:
+      sums      — DataFrame по (flight, weekday): total_bkd, total_nsh, total_den_brd,
+                  flights_with_den_brd, count;
+      rates     — Series (flight, weekday, rate) -> сколько дат с таким per-flight rate;
+                  по нему считаются медиана и std, и оно же идёт в моделирование;
+      segments  — {рейс: Counter сегментов};
+      rows      — ключи строк (flight, day, segment) с weekday, bkd, nsh, den_brd: по ним
+                  merge_partials находит строки, которые есть в нескольких файлах.
+    """
+    sums, rates, flight_segments = _group_sums(records)
+    return {'sums': sums, 'rates': rates, 'segments': dict(flight_segments), 'rows': compact_rows(records)}
+
+
+def compact_rows(records):
+    """Строки records в компактном виде: рейс и сегмент — категории, дата — номер дня от 1970-01-01 (int32)."""
+    return pd.DataFrame({
+        'flight': records['flight'].astype('category'),
+        'day': records['date'].to_numpy().astype('datetime64[D]').astype('int32'),
+        'segment': records['segment'].astype('category'),
+        'weekday': records['weekday'],
+        **{column: records[column].astype('int32') for column in ('bkd', 'nsh', 'den_brd')},
+    })
+
+
+def combine_partials(partials):
+    """Простая сумма частичных агрегатов (без поиска повторов) — например, кусков одного файла."""
+    flight_segments = defaultdict(Counter)
+    for partial in partials:
+        for flight, counter in partial['segments'].items():
+            flight_segments[flight].update(counter)
+    # порядок групп — порядок первого появления, как у compute_group_stats
+    return {
+        'sums': pd.concat([partial['sums'] for partial in partials]).groupby(
+            level=['flight', 'weekday'], sort=False).sum(),
+        'rates': pd.concat([partial['rates'] for partial in partials]).groupby(
+            level=['flight', 'weekday', 'rate'], sort=False).sum(),
+        'segments': dict(flight_segments),
+        'rows': _concat_rows([partial['rows'] for partial in partials]),
+    }
+
+
+def _concat_rows(frames):
+    """pd.concat для rows из partial_aggregates, сохраняющий flight и segment категориями.
+
+    Обычный concat категорий с разным набором значений превращает их в строки — на
+    миллионах строк это дольше самого слияния, а так перекодируются только коды.
+    """
+    categories = ['flight', 'segment']
+    # у выгрузки без годных строк категории могут быть другого типа (object) — union_categoricals их не сольёт
+    frames = [frame for frame in frames if len(frame)] or frames[:1]
+    rows = pd.concat([frame.drop(columns=categories) for frame in frames], ignore_index=True)
+    for column in categories:
+        rows[column] = union_categoricals([frame[column] for frame in frames])
+    return rows[frames[0].columns]
+
+
+def _distribution_stats(values, counts):
+    """Медиана (как у statistics.median) и std (ddof=0) по распределению: значения по возрастанию и их частоты.
+
+    Частоты могут быть и дробными (веса затухания): медиана — среднее нижнего и верхнего
+    значений, на которых накопленная частота доходит до половины; при целых частотах это
+    ровно два средних значения statistics.median.
+    """
+    positions = np.cumsum(counts)
+    total = positions[-1]
+    # допуск — чтобы сумма дробных весов, чуть не дошедшая до половины из-за округления, считалась половиной
+    tolerance = total * 1e-9
+    median = (values[np.searchsorted(positions, total / 2 - tolerance)]
+              + values[np.searchsorted(positions, total / 2 + tolerance, side='right')]) / 2
+    mean = np.dot(values, counts) / total
+    return float(median), float(np.sqrt(np.dot((values - mean) ** 2, counts) / total))
+
+
+def merge_partials(partials):
+    """Сливает частичные агрегаты нескольких выгрузок в группы, распределения и сегменты.
+
+    Строка (рейс, дата, сегмент), которая есть в нескольких файлах, учитывается один
+    раз — из последнего файла в списке, как при импорте в историю: её вклад из более
+    ранних файлов вычитается из сумм, распределений rate и сегментов. Повторы внутри
+    одного файла не трогаются (так же их считает parse_flights_file).
+    Возвращает (group_stats, rate_distributions, flight_segments, число вычтенных строк,
+    оставшиеся строки в виде compact_rows).
+    """
+    combined = combine_partials(partials)
+    sums, rates, flight_segments = combined['sums'], combined['rates'], defaultdict(Counter, combined['segments'])
+    rows = combined['rows']
+
+    duplicates = 0
+    # без единой годной строки (во всех файлах) искать повторы не в чем — day.min() пустого массива упал бы
+    if len(partials) > 1 and len(rows):
+        source = np.repeat(np.arange(len(partials)), [len(partial['rows']) for partial in partials])
+        # ключ (рейс, дата, сегмент) одним целым по кодам категорий — группировка по нему в разы быстрее
+        day = rows['day'].to_numpy().astype('int64')
+        key = ((rows['flight'].cat.codes.to_numpy().astype('int64') * len(rows['segment'].cat.categories)
+                + rows['segment'].cat.codes.to_numpy()) * (int(day.max() - day.min()) + 1) + (day - day.min()))
+        # строка вытеснена, если тот же ключ есть в файле дальше по списку
+        latest = pd.Series(source).groupby(key, sort=False).transform('max').to_numpy()
+        overwritten = rows[source < latest]
+        rows = rows[source >= latest]
+        duplicates = len(overwritten)
+        if duplicates:
+            dropped_sums, dropped_rates, dropped_segments = _group_sums(overwritten)
+            sums = sums - dropped_sums.reindex(sums.index, fill_value=0)
+            rates = rates - dropped_rates.reindex(rates.index, fill_value=0)
+            rates = rates[rates > 0]
+            for flight, counter in dropped_segments.items():
+                flight_segments[flight].subtract(counter)
+                flight_segments[flight] = +flight_segments[flight]
+
+    distributions = {}
+    medians, stds = {}, {}
+    ordered = rates.reset_index(name='count').sort_values(['flight', 'weekday', 'rate'], kind='stable')
+    for key, group in ordered.groupby(['flight', 'weekday'], sort=False):
+        values, counts = group['rate'].to_numpy(), group['count'].to_numpy()
+        distributions[key] = (values, counts)
+        medians[key], stds[key] = _distribution_stats(values, counts)
+
+    stats = sums.astype('int64')
+    stats['rate_median'] = [medians[key] for key in stats.index]
+    stats['rate_std'] = [stds[key] for key in stats.index]
+    return _finish_group_stats(stats), distributions, dict(flight_segments), duplicates, rows
+
+
+def parse_file_partial(raw_bytes):
+    """Разбирает одну выгрузку в частичные агрегаты (partial_aggregates) — работа для процесса из пула.
+
+    Возвращает словарь с ключами partial, total_rows, skipped_rows, has_den_brd, stages и error.
+    """
+    if len(raw_bytes) > STREAMING_THRESHOLD_BYTES:
+        # большой файл — кусками, чтобы несколько работников не держали в памяти по пять его копий;
+        # накопители stream_flights_file при этом считаются зря, но это меньше разбора
+        parts = []
+        parsed = stream_flights_file(io.BytesIO(raw_bytes), on_records=lambda records: parts.append(
+            partial_aggregates(records)), date_index=False)
+        if parsed['error']:
+            return {'error': parsed['error'], 'stages': parsed.get('stages', [])}
+        return {'partial': combine_partials(parts), 'total_rows': parsed['total_rows'],
+                'skipped_rows': parsed['skipped_rows'], 'has_den_brd': parsed['has_den_brd'],
+                'stages': parsed['stages'], 'error': None}
+
+    timer = StageTimer()
+    parsed = _parse_records(raw_bytes, timer)
+    if isinstance(parsed, str):
+        return {'error': parsed, 'stages': timer.report()}
+    records, skipped_rows, has_den_brd = parsed
+    with timer.stage('aggregate', rows=len(records)):
+        partial = partial_aggregates(records)
+    return {'partial': partial, 'total_rows': len(records), 'skipped_rows': skipped_rows,
+            'has_den_brd': has_den_brd, 'stages': timer.report(), 'error': None}
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def _shared_parse_pool():
+    """Общий пул процессов для разбора: создаётся один раз, чтобы не платить за запуск работников на каждую загрузку."""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # spawn, а не fork: интерфейс многопоточный, а fork копирует и чужие захваченные блокировки
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        return _parse_pool
+
+
+def _reset_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        _parse_pool = None
+
+
+def parse_flights_files(raw_files, workers=None, date_index=True):
+    """Разбирает несколько выгрузок параллельно и сливает их в один датасет.
+
+    raw_files — байты файлов по порядку: при повторе (рейс, дата, сегмент) побеждает более
+    поздний файл. Каждый файл разбирается в своём процессе (parse_file_partial) в частичные
+    агрегаты, которые потом сливает merge_partials, так что время растёт с размером
+    самого большого файла, а не с их суммой, пока хватает ядер. workers=None — общий
+    пул на PARSE_WORKERS процессов, 1 — разбор в текущем процессе.
+
+    Результат того же вида, что у parse_flights_file, плюс duplicate_rows — сколько
+    строк учтено один раз из нескольких файлов — и file_errors — {номер файла: текст
+    ошибки} для файлов, которые не удалось разобрать. date_index=False, как и у
+    parse_flights_file, не строит DateIndex (records = None, date_range остаётся).
+    """
+    timer = StageTimer()
+    with timer.stage('parse') as parse_stage:
+        if workers == 1 or len(raw_files) == 1:
+            results = [parse_file_partial(raw_bytes) for raw_bytes in raw_files]
+        elif workers is None:
+            try:
+                results = list(_shared_parse_pool().map(parse_file_partial, raw_files))
+            except BrokenProcessPool:
+                # работник упал (например, от нехватки памяти) — следующая загрузка соберёт пул заново
+                _reset_parse_pool()
+                raise
+        else:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results = list(pool.map(parse_file_partial, raw_files))
+        parsed = [result for result in results if not result['error']]
+        parse_stage['rows'] = sum(result['total_rows'] for result in parsed)
+
+    file_errors = {index: result['error'] for index, result in enumerate(results) if result['error']}
+    if not parsed:
+        return {'error': results[0]['error'], 'file_errors': file_errors, 'stages': timer.report()}
+
+    with timer.stage('merge', rows=parse_stage['rows']):
+        group_stats, distributions, flight_segments, duplicates, rows = merge_partials(
+            [result['partial'] for result in parsed])
+
+    index = date_range = None
+    if date_index:
+        with timer.stage('index', rows=len(rows)):
+            index = DateIndex(CompactRecords(rows))
+    elif len(rows):
+        date_range = (_from_day_number(rows['day'].min()), _from_day_number(rows['day'].max()))
+    del rows
+
+    with timer.stage('build'):
+        dataset = _build_dataset(index.records if index is not None else None, group_stats, distributions,
+                                 flight_segments, has_den_brd=any(result['has_den_brd'] for result in parsed),
+                                 total_rows=sum(result['total_rows'] for result in parsed) - duplicates,
+                                 skipped_rows=sum(result['skipped_rows'] for result in parsed), date_index=index,
+                                 date_range=date_range)
+    dataset['duplicate_rows'] = duplicates
+    dataset['file_errors'] = file_errors
+    dataset['stages'] = timer.report()
+    return dataset
+
+
+def _day_number(value):
+    """datetime.date -> номер дня от 1970-01-01, как в compact_rows и в таблице flights истории."""
+    return (value - date(1970, 1, 1)).days
+
+
+def _from_day_number(day):
+    """Номер дня от 1970-01-01 -> datetime.date."""
+    return date(1970, 1, 1) + timedelta(days=int(day))
+
+
+def _window_sum(cumulative, lo, hi, starts):
+    """Сумма по срезам [lo, hi) из накопленных внутри групп сумм (starts — начала групп)."""
+    upper = np.where(hi > starts, cumulative[np.maximum(hi - 1, 0)], 0)
+    lower = np.where(lo > starts, cumulative[np.maximum(lo - 1, 0)], 0)
+    return upper - lower
+
+
+def _narrow_int(values):
+    """Целые values в самом узком знаковом типе (int8 ... int64), в который помещаются все значения."""
+    values = np.asarray(values)
+    low, high = (values.min(), values.max()) if len(values) else (0, 0)
+    for dtype in (np.int8, np.int16, np.int32):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return values.astype(dtype, copy=False)
+    return values.astype(np.int64, copy=False)
+
+
+class CompactRecords:
+    """Строки выгрузки в компактном виде: по массиву на колонку, без объекта Python на строку.
+
+    Рейс и сегмент хранятся кодами (сами строки — один раз, в flights и segments),
+    дата — номером дня от 1970-01-01 (int32), bkd, nsh и den_brd — в самом узком
+    целом типе, в который помещаются значения; день недели следует из даты и не
+    хранится. Строки отсортированы по (рейс, день недели, дата): у каждой пары один
+    непрерывный кусок offsets[i]:offsets[i + 1], и срез по нему — без копирования.
+    Выходит около 13 байт на строку.
+    """
+
+    def __init__(self, rows):
+        """rows — DataFrame с колонками flight, day (номер дня), segment, bkd, nsh, den_brd (например, compact_rows)."""
+        flight_codes, flights = pd.factorize(rows['flight'])
+        segment_codes, segments = pd.factorize(rows['segment'])
+        self.flights = np.asarray(flights, dtype=object)
+        self.segments = np.asarray(segments, dtype=object)
+        day = rows['day'].to_numpy().astype(np.int32)
+        # 01.01.1970 — четверг (weekday 3)
+        group, group_keys = pd.factorize(flight_codes.astype(np.int64) * 7 + (day + 3) % 7)
+        order = np.lexsort((day, group))
+
+        # группы в порядке первого появления — как у compute_group_stats
+        self.keys = [(self.flights[key // 7], int(key % 7)) for key in group_keys]
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(group, minlength=len(group_keys)))))
+        self.flight = _narrow_int(flight_codes[order])
+        self.segment = _narrow_int(segment_codes[order])
+        self.day = day[order]
+        self.bkd, self.nsh, self.den_brd = (_narrow_int(rows[column].to_numpy()[order])
+                                            for column in ('bkd', 'nsh', 'den_brd'))
+        self._positions = {key: position for position, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.day)
+
+    def block(self, flight, weekday):
+        """Срез строк пары (рейс, день недели) — по датам; пустой, если такой пары нет."""
+        position = self._positions.get((flight, weekday))
+        if position is None:
+            return slice(0, 0)
+        return slice(int(self.offsets[position]), int(self.offsets[position + 1]))
+
+    def rates(self, rows=slice(None)):
+        """Per-flight rate (nsh / bkd, 0 при bkd = 0) строк rows (по умолчанию всех)."""
+        bkd, nsh = self.bkd[rows], self.nsh[rows]
+        return np.divide(nsh, bkd, out=np.zeros(len(bkd)), where=bkd > 0)
+
+    def to_frame(self, rows=slice(None)):
+        """Строки (по умолчанию все) в виде records: flight, date, weekday, segment, bkd, nsh, den_brd."""
+        day = self.day[rows]
+        return pd.DataFrame({
+            'flight': self.flights[self.flight[rows]],
+            'date': pd.to_datetime(day.astype('datetime64[D]')),
+            'weekday': ((day + 3) % 7).astype('int8'),
+            'segment': self.segments[self.segment[rows]],
+            **{column: getattr(self, column)[rows].astype('int64') for column in ('bkd', 'nsh', 'den_brd')},
+        })
+
+    @property
+    def nbytes(self):
+        """Память массивов и строк рейсов/сегментов, байт."""
+        arrays = (self.flight, self.segment, self.day, self.bkd, self.nsh, self.den_brd, self.offsets)
+        strings = sum(sys.getsizeof(value) for value in (*self.flights, *self.segments))
+        # ключи групп и словарь позиций — по кортежу и записи словаря на группу
+        return sum(array.nbytes for array in arrays) + strings + len(self.keys) * 200
+
+
+class DateIndex:
+    """Индекс строк по датам: статистика за любой период и с затуханием старых дат.
+
+    Строится поверх CompactRecords, где строки каждой пары (рейс, день недели) уже
+    лежат одним непрерывным куском по датам. Границы периода во всех группах — один
+    бинарный поиск по общему ключу (группа, дата). Для bkd, nsh, den_brd, per-flight
+    rate и rate² посчитаны накопленные внутри группы суммы, так что суммы, rate и
+    разброс за период — разность накопленных сумм; суммы с весами затухания считаются
+    один раз на период полураспада (последний запомненный переиспользуется). Строки
+    периода нужны только медиане и распределению rate: для них хранится порядок строк
+    по rate внутри группы, и строки периода выбираются из него маской, без сортировки.
+    """
+
+    def __init__(self, records):
+        """records — CompactRecords."""
+        self.records = records
+        self.keys, self.offsets, self.day = records.keys, records.offsets, records.day
+        self._first_day = int(self.day.min()) if len(self.day) else 0
+        self._last_day = int(self.day.max()) if len(self.day) else 0
+        # ключ (группа, дата) одним целым: строки по нему уже отсортированы
+        self._span = self._last_day - self._first_day + 1
+        key_dtype = np.int32 if len(self.keys) * self._span <= np.iinfo(np.int32).max else np.int64
+        group = self._groups()
+        self._group_day = (group.astype(key_dtype) * self._span + (self.day - self._first_day)).astype(key_dtype)
+        rates = records.rates()
+        # суммы внутри группы редко выходят за int32, а то и int16
+        self._sums = {
+            'bkd': _narrow_int(self._cumsum(records.bkd)),
+            'nsh': _narrow_int(self._cumsum(records.nsh)),
+            'den_brd': _narrow_int(self._cumsum(records.den_brd)),
+            'had_den_brd': _narrow_int(self._cumsum(records.den_brd > 0)),
+            'rate': self._cumsum(rates),
+            'rate2': self._cumsum(rates ** 2),
+        }
+        # строки, упорядоченные по (группа, rate); при равных rate — по дате
+        self._by_rate = np.lexsort((rates, group)).astype(np.int32)
+        self._decay = None  # (half_life, накопленные суммы с весами)
+
+    def __len__(self):
+        return len(self.day)
+
+    @property
+    def first_date(self):
+        return _from_day_number(self._first_day)
+
+    @property
+    def last_date(self):
+        return _from_day_number(self._last_day)
+
+    @property
+    def nbytes(self):
+        """Память индекса вместе с его CompactRecords (и суммами затухания, если посчитаны), байт."""
+        arrays = [*self._sums.values(), self._group_day, self._by_rate]
+        if self._decay is not None:
+            arrays += self._decay[1].values()
+        return self.records.nbytes + sum(array.nbytes for array in arrays)
+
+    def _cumsum(self, values):
+        """Накопленные внутри каждой группы суммы (int64 для целых, float64 для дробных)."""
+        if np.issubdtype(np.asarray(values).dtype, np.floating):
+            # дробные — по группам, а не разностью общей суммы: иначе у поздних групп малые
+            # разности терялись бы на фоне больших сумм (особенно с весами затухания)
+            return pd.Series(values).groupby(self._groups(), sort=False).cumsum().to_numpy()
+        cumulative = np.cumsum(values, dtype=np.int64)
+        # вычитаем то, что накопилось до начала группы
+        before = np.concatenate(([0], cumulative))[self.offsets[:-1]]
+        return cumulative - np.repeat(before, np.diff(self.offsets))
+
+    def _groups(self):
+        """Номер группы каждой строки (int32)."""
+        return np.repeat(np.arange(len(self.keys), dtype=np.int32), np.diff(self.offsets))
+
+    def _bounds(self, start_day, end_day):
+        """Начало и конец (не включая) периода в каждой группе: один бинарный поиск по ключу (группа, дата)."""
+        base = np.arange(len(self.keys), dtype=np.int64) * self._span
+        # за пределами дат индекса граница упирается в начало или конец группы
+        start = min(max(start_day - self._first_day, 0), self._span)
+        end = min(max(end_day - self._first_day, -1), self._span - 1)
+        lo = np.searchsorted(self._group_day, base + start, side='left')
+        hi = np.searchsorted(self._group_day, base + end, side='right')
+        return lo, hi
+
+    def _weights(self, half_life, rows):
+        """Веса строк rows: 2^(−(последняя дата − дата) / half_life)."""
+        # отсчёт от последней даты индекса: веса не больше 1, а их отношения (а только они и
+        # нужны) такие же, как при отсчёте от конца любого периода
+        return np.exp2((self.day[rows].astype(np.float64) - self._last_day) / half_life)
+
+    def _decay_sums(self, half_life):
+        """Накопленные внутри групп суммы с весами затухания: веса, bkd, nsh, rate и rate²."""
+        if self._decay is not None and self._decay[0] == half_life:
+            return self._decay[1]
+        weights = self._weights(half_life, slice(None))
+        rates = self.records.rates()
+        sums = {
+            'weight': self._cumsum(weights),
+            'bkd': self._cumsum(weights * self.records.bkd),
+            'nsh': self._cumsum(weights * self.records.nsh),
+            'rate': self._cumsum(weights * rates),
+            'rate2': self._cumsum(weights * rates ** 2),
+        }
+        self._decay = (half_life, sums)
+        return sums
+
+    def window(self, start=None, end=None, half_life=None):
+        """Статистика за период [start, end] (datetime.date включительно, None — без границы).
+
+        Возвращает (group_stats, rate_distributions) того же вида, что compute_group_stats и
+        rate_distributions, по группам, у которых в периоде есть даты. С half_life (дней)
+        дата весит вдвое меньше каждые half_life дней до последней даты: по весам считаются
+        rate, avg_bookings, медиана, std и частоты распределения, а count, суммы и Den Brd
+        остаются фактическими.
+        """
+        start_day = _day_number(start) if start is not None else np.iinfo(np.int32).min
+        end_day = _day_number(end) if end is not None else np.iinfo(np.int32).max
+        all_lo, all_hi = self._bounds(start_day, end_day)
+        present = np.flatnonzero(all_hi > all_lo)
+        lo, hi, starts = all_lo[present], all_hi[present], self.offsets[:-1][present]
+        count = hi - lo
+        keys = [self.keys[position] for position in present]
+        sums = {name: _window_sum(cumulative, lo, hi, starts) for name, cumulative in self._sums.items()}
+
+        stats = pd.DataFrame({
+            **{column: sums[name].astype(np.int64) for column, name in (
+                ('total_bkd', 'bkd'), ('total_nsh', 'nsh'), ('total_den_brd', 'den_brd'),
+                ('flights_with_den_brd', 'had_den_brd'))},
+            'count': count,
+        }, index=pd.MultiIndex.from_tuples(keys, names=['flight', 'weekday']))
+
+        # строки периода в порядке (группа, rate): маска по границам периода своей группы
+        in_window = (self._by_rate >= np.repeat(all_lo, np.diff(self.offsets))) & (
+            self._by_rate < np.repeat(all_hi, np.diff(self.offsets)))
+        rows = self._by_rate[in_window]
+        rates = self.records.rates(rows)
+        row_starts = np.concatenate(([0], np.cumsum(count)))
+        # начала серий одинаковых rate внутри группы — это и есть значения распределения
+        new_value = np.ones(len(rows), dtype=bool)
+        new_value[1:] = rates[1:] != rates[:-1]
+        new_value[row_starts[:-1]] = True
+        value_starts = np.flatnonzero(new_value)
+        values = rates[value_starts]
+        # у каждой группы значения идут куском value_offsets[i]:value_offsets[i + 1]
+        value_offsets = np.searchsorted(value_starts, row_starts)
+
+        if half_life is None:
+            counts = np.diff(np.append(value_starts, len(rows)))
+            # медиана как у statistics.median: среднее двух средних строк отсортированной группы
+            stats['rate_median'] = (rates[row_starts[:-1] + (count - 1) // 2] + rates[row_starts[:-1] + count // 2]) / 2
+            stats['rate_std'] = _std_from_sums(count, sums['rate'], sums['rate2'], self._sums['rate2'][hi - 1])
+            distributions = {key: (values[a:b], counts[a:b])
+                             for key, a, b in zip(keys, value_offsets[:-1], value_offsets[1:])}
+            return _finish_group_stats(stats), distributions
+
+        decay_sums = self._decay_sums(half_life)
+        weighted = {name: _window_sum(cumulative, lo, hi, starts) for name, cumulative in decay_sums.items()}
+        counts = np.add.reduceat(self._weights(half_life, rows), value_starts) if len(rows) else np.zeros(0)
+        value_group = np.repeat(np.arange(len(keys)), np.diff(value_offsets))
+        # то же правило медианы, что и без затухания (_distribution_stats), для всех групп сразу:
+        # накопленные веса внутри группы, первое значение, где они доходят до половины, и первое — где переходят её
+        positions = pd.Series(counts).groupby(value_group, sort=False).cumsum().to_numpy()
+        total = positions[value_offsets[1:] - 1]
+        tolerance = total * 1e-9
+        below = positions < np.repeat(total / 2 - tolerance, np.diff(value_offsets))
+        not_above = positions <= np.repeat(total / 2 + tolerance, np.diff(value_offsets))
+        lower = value_offsets[:-1] + _group_count(below, value_offsets)
+        upper = value_offsets[:-1] + _group_count(not_above, value_offsets)
+        stats['rate_median'] = (values[lower] + values[upper]) / 2
+        stats['rate_std'] = _std_from_sums(weighted['weight'], weighted['rate'], weighted['rate2'],
+                                           decay_sums['rate2'][hi - 1])
+        stats = _finish_group_stats(stats)
+        stats['rate'] = np.divide(weighted['nsh'], weighted['bkd'], out=np.zeros(len(stats)),
+                                  where=weighted['bkd'] > 0)
+        # округление до floor: при равных весах 150.0 приходит как 149.99999999999997, а должно быть
+        # ровно total_bkd // count, как без затухания
+        stats['avg_bookings'] = np.floor(np.round(weighted['bkd'] / weighted['weight'], 6)).astype(np.int64)
+        # частоты в «строках»: сумма весов растянута до числа строк периода
+        scaled = counts * np.repeat(count / total, np.diff(value_offsets))
+        distributions = {key: (values[a:b], scaled[a:b])
+                         for key, a, b in zip(keys, value_offsets[:-1], value_offsets[1:])}
+        return stats, distributions
+
+
+def _std_from_sums(total, rate_sum, rate2_sum, rate2_cumulative):
+    """Std (ddof=0) rate по суммам частот (или весов), rate и rate² за период.
+
+    rate2_cumulative — накопленная сумма rate² группы на конце периода: от неё считались
+    разности, и ошибка округления (порядка 1e-16 от неё) при нулевом разбросе даёт не
+    ноль, а шум — дисперсия ниже этого порога считается нулём.
+    """
+    mean = rate_sum / total
+    variance = rate2_sum / total - mean ** 2
+    return np.sqrt(np.where(variance > rate2_cumulative / total * 1e-12, variance, 0.0))
+
+
+def _group_count(flags, offsets):
+    """Число True во flags в каждом куске offsets[i]:offsets[i + 1] (все куски непустые)."""
+    cumulative = np.concatenate(([0], np.cumsum(flags)))
+    return cumulative[offsets[1:]] - cumulative[offsets[:-1]]
+
+
+def dataset_window(dataset, start=None, end=None, half_life=None, date_index=None):
+    """Датасет за период [start, end] с необязательным затуханием старых дат (см. DateIndex.window).
+
+    Возвращает новый словарь поверх dataset (сам dataset общий для сессий и не меняется):
+    group_stats, rate_distributions, day_stats и total_rows — только по периоду. Рейсы без
+    дат в периоде остаются в day_stats с пустой статистикой. date_index — если индекс
+    не лежит в самом dataset (история, load_history_index).
+    """
+    if date_index is None:
+        date_index = dataset['date_index']
+    group_stats, distributions = date_index.window(start, end, half_life)
+    day_stats = {flight: {} for flight in dataset['all_flights']}
+    day_stats.update(day_stats_by_flight(group_stats))
+    return dict(dataset, group_stats=group_stats, rate_distributions=distributions, day_stats=day_stats,
+                total_rows=int(group_stats['count'].sum()))
+
+
+def dataset_nbytes(dataset):
+    """Примерный объём датасета в памяти, байт (словарь parse_flights_file и др. или DateIndex).
+
+    Считаются массивы строк и индекса дат, group_stats и распределения rate; day_stats и
+    сегменты — по sys.getsizeof словарей, без вложенных чисел.
+    """
+    if isinstance(dataset, DateIndex):
+        return dataset.nbytes
+    size = 0
+    index, records = dataset.get('date_index'), dataset.get('records')
+    if index is not None:
+        size += index.nbytes
+    if records is not None and (index is None or records is not index.records):
+        size += records.nbytes
+    if dataset.get('group_stats') is not None:
+        size += int(dataset['group_stats'].memory_usage(deep=True).sum())
+    size += sum(values.nbytes + counts.nbytes for values, counts in (dataset.get('rate_distributions') or {}).values())
+    for name in ('day_stats', 'flight_segments'):
+        size += sum(sys.getsizeof(value) + sum(map(sys.getsizeof, value.values()))
+                    for value in (dataset.get(name) or {}).values())
+    return size
+
+
+class DatasetCache:
+    """LRU разобранных выгрузок с бюджетом в байтах, общий для всех сессий.
+
+    Ключ — хэш содержимого, поэтому одинаковые загрузки хранятся один раз: пока одна
+    сессия разбирает файл, другие с тем же ключом ждут её результата, а не разбирают
+    его параллельно. Когда суммарный объём (dataset_nbytes) превышает budget_bytes,
+    вытесняются давно не использованные датасеты; последний использованный остаётся,
+    даже если один не помещается в бюджет. Сессии, которые ещё держат вытесненный
+    датасет, дорабатывают с ним — память освободится, когда они его отпустят.
+    """
+
+    def __init__(self, budget_bytes=DATASET_CACHE_BYTES):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()  # ключ -> (датасет, объём); в начале — давно не использованные
+        self._loading = {}  # ключ -> Lock, пока датасет разбирается
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Датасет из кэша (и отметка, что он использован) или None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def get_or_load(self, key, load):
+        """Датасет из кэша, а если его нет — load() (один на ключ, сколько бы сессий ни ждало)."""
+        dataset = self.get(key)
+        if dataset is not None:
+            return dataset
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        with key_lock:
+            dataset = self.get(key)
+            if dataset is None:
+                try:
+                    dataset = load()
+                    # кладём в кэш до снятия блокировки ключа: иначе другая сессия успеет загрузить его повторно
+                    self.put(key, dataset)
+                finally:
+                    with self._lock:
+                        self._loading.pop(key, None)
+        return dataset
+
+    def put(self, key, dataset):
+        with self._lock:
+            self._entries[key] = (dataset, dataset_nbytes(dataset))
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def usage(self):
+        """(занято байт, число датасетов)."""
+        with self._lock:
+            return sum(size for _, size in self._entries.values()), len(self._entries)
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        while total > self.budget_bytes and len(self._entries) > 1:
+            key, (_, size) = self._entries.popitem(last=False)
+            total -= size
+            logger.info(json.dumps({'event': 'cache_evict', 'key': str(key)[:80], 'mb': round(size / 2 ** 20, 1)},
+                                   ensure_ascii=False))
+
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS flights (
+    flight TEXT NOT NULL,
+    date INTEGER NOT NULL,  -- дни от 1970-01-01
+    segment TEXT NOT NULL,
+    weekday INTEGER NOT NULL,
+    bkd INTEGER NOT NULL,
+    nsh INTEGER NOT NULL,
+    den_brd INTEGER NOT NULL,
+    PRIMARY KEY (flight, date, segment)
+) WITHOUT ROWID;
+
+-- готовые суммы по (рейс, день недели); position — порядок дней внутри рейса
+CREATE TABLE IF NOT EXISTS group_stats (
+    flight TEXT NOT NULL,
+    weekday INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    total_bkd INTEGER NOT NULL,
+    total_nsh INTEGER NOT NULL,
+    total_den_brd INTEGER NOT NULL,
+    flights_with_den_brd INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    rate_median REAL NOT NULL,
+    rate_std REAL NOT NULL,
+    PRIMARY KEY (flight, weekday)
+);
+
+-- распределение per-flight rate по (рейс, день недели) для моделирования овербукинга: гистограмма
+-- с шагом HISTORY_RATE_RESOLUTION одной строкой, значения (float64) и частоты (int64) — байтами массивов
+CREATE TABLE IF NOT EXISTS rate_histograms (
+    flight TEXT NOT NULL,
+    weekday INTEGER NOT NULL,
+    rates BLOB NOT NULL,
+    counts BLOB NOT NULL,
+    PRIMARY KEY (flight, weekday)
+);
+
+CREATE TABLE IF NOT EXISTS flight_segments (
+    flight TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (flight, segment)
+);
+
+CREATE TABLE IF NOT EXISTS imports (
+    file_hash TEXT PRIMARY KEY,
+    imported_at TEXT NOT NULL,
+    total_rows INTEGER NOT NULL,
+    skipped_rows INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def open_history(history_dir):
+    """Соединение с базой истории в history_dir (каталог и таблицы создаются при первом обращении)."""
+    os.makedirs(history_dir, exist_ok=True)
+    connection = sqlite3.connect(os.path.join(history_dir, HISTORY_DB_NAME), timeout=30)
+    connection.executescript(HISTORY_SCHEMA)
+    return connection
+
+
+def history_version(history_dir):
+    """Номер версии истории: растёт с каждым импортом, 0 — истории ещё нет."""
+    if not os.path.exists(os.path.join(history_dir, HISTORY_DB_NAME)):
+        return 0
+    with closing(open_history(history_dir)) as connection:
+        row = connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    return int(row[0]) if row else 0
+
+
+def _store_records(connection, records, touched_flights):
+    """Вливает records в таблицу flights; повтор (Рейс, Дата, Сегмент) заменяет старую запись."""
+    days = records['date'].to_numpy().astype('datetime64[D]').astype('int64')
+    connection.executemany(
+        "INSERT OR REPLACE INTO flights (flight, date, segment, weekday, bkd, nsh, den_brd) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        zip(records['flight'].tolist(), days.tolist(), records['segment'].tolist(), records['weekday'].tolist(),
+            records['bkd'].tolist(), records['nsh'].tolist(), records['den_brd'].tolist()),
+    )
+    touched_flights.update(records['flight'].unique().tolist())
+
+
+def _refresh_history_stats(connection, flights):
+    """Пересчитывает group_stats, rate_histograms, flight_segments и границы дат только для рейсов, которых коснулся импорт."""
+    if not flights:
+        # в выгрузке не нашлось ни одной годной строки — пересчитывать нечего (а пустой
+        # read_sql_query вернул бы колонки типа object, на которых падает compute_group_stats)
+        return
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS touched (flight TEXT PRIMARY KEY)")
+    connection.execute("DELETE FROM touched")
+    connection.executemany("INSERT INTO touched (flight) VALUES (?)", ((flight,) for flight in flights))
+
+    # по дате — чтобы порядок дней и сегментов при равенстве был как в хронологической выгрузке
+    records = pd.read_sql_query(
+        "SELECT flight, date, weekday, segment, bkd, nsh, den_brd FROM flights JOIN touched USING (flight) "
+        "ORDER BY flight, date", connection)
+    stats = compute_group_stats(records)
+    flight_segments = defaultdict(Counter)
+    count_segments(records, flight_segments)
+
+    connection.execute("DELETE FROM group_stats WHERE flight IN (SELECT flight FROM touched)")
+    connection.execute("DELETE FROM rate_histograms WHERE flight IN (SELECT flight FROM touched)")
+    connection.execute("DELETE FROM flight_segments WHERE flight IN (SELECT flight FROM touched)")
+    positions = stats.groupby(level='flight', sort=False).cumcount()
+    connection.executemany(
+        "INSERT INTO group_stats (flight, weekday, position, total_bkd, total_nsh, total_den_brd, "
+        "flights_with_den_brd, count, rate_median, rate_std) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        ((flight, int(weekday), int(position), int(row.total_bkd), int(row.total_nsh), int(row.total_den_brd),
+          int(row.flights_with_den_brd), int(row.count), float(row.rate_median), float(row.rate_std))
+         for (flight, weekday), position, row in zip(stats.index, positions, stats.itertuples())),
+    )
+    connection.executemany(
+        "INSERT INTO rate_histograms (flight, weekday, rates, counts) VALUES (?, ?, ?, ?)",
+        ((flight, int(weekday), rates.astype(np.float64).tobytes(), counts.astype(np.int64).tobytes())
+         for (flight, weekday), (rates, counts)
+         in rate_distributions(records, resolution=HISTORY_RATE_RESOLUTION).items()),
+    )
+    connection.executemany(
+        "INSERT INTO flight_segments (flight, segment, position, count) VALUES (?, ?, ?, ?)",
+        ((flight, segment, position, count)
+         for flight, counter in flight_segments.items()
+         for position, (segment, count) in enumerate(counter.items())),
+    )
+
+    # границы дат держим в meta: строки только добавляются, так что они только расширяются,
+    # а load_history не приходится искать MIN/MAX по всей таблице flights
+    meta = dict(connection.execute("SELECT key, value FROM meta WHERE key IN ('first_day', 'last_day')").fetchall())
+    first_day, last_day = int(records['date'].min()), int(records['date'].max())
+    if meta:
+        first_day, last_day = min(first_day, int(meta['first_day'])), max(last_day, int(meta['last_day']))
+    connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                           [('first_day', str(first_day)), ('last_day', str(last_day))])
+
+
+def _upgrade_history(connection):
+    """Достраивает rate_histograms и границы дат в meta для базы, созданной до их появления (один раз)."""
+    if (connection.execute("SELECT EXISTS (SELECT 1 FROM group_stats)").fetchone()[0]
+            and not connection.execute("SELECT EXISTS (SELECT 1 FROM rate_histograms)").fetchone()[0]):
+        # пересчёт по всем рейсам; прежнюю таблицу распределений (по строке на каждое значение rate) удаляем
+        _refresh_history_stats(connection, [row[0] for row in
+                                            connection.execute("SELECT DISTINCT flight FROM group_stats")])
+        connection.execute("DROP TABLE IF EXISTS rate_counts")
+
+
+def import_into_history(history_dir, file_hash, fileobj, streaming=False):
+    """Добавляет выгрузку в историю, если файл с таким хэшем ещё не импортировали.
+
+    Новые строки вливаются в flights с дедупликацией по (Рейс, Дата, Сегмент), после чего
+    готовая статистика пересчитывается только для затронутых рейсов. Возвращает словарь
+    с ключами total_rows, skipped_rows, already_imported, stages и error.
+    """
+    timer = StageTimer()
+
+    def store(records):
+        with timer.stage('store', rows=len(records)):
+            _store_records(connection, records, touched_flights)
+
+    with closing(open_history(history_dir)) as connection, connection:
+        row = connection.execute(
+            "SELECT total_rows, skipped_rows FROM imports WHERE file_hash = ?", (file_hash,)).fetchone()
+        if row:
+            return {'total_rows': row[0], 'skipped_rows': row[1], 'already_imported': True, 'stages': [],
+                    'error': None}
+
+        # до импорта: иначе затронутые им рейсы получили бы гистограммы, а остальные — нет
+        _upgrade_history(connection)
+        touched_flights = set()
+        if streaming:
+            fileobj.seek(0)
+            parsed = stream_flights_file(fileobj, on_records=store, date_index=False)
+        else:
+            # для истории нужны только сами строки — без статистики и индекса дат
+            parsed = _parse_records(fileobj.getvalue(), timer)
+            if not isinstance(parsed, str):
+                records, skipped_rows, has_den_brd = parsed
+                store(records)
+                parsed = {'total_rows': len(records), 'skipped_rows': skipped_rows, 'has_den_brd': has_den_brd,
+                          'stages': [], 'error': None}
+                del records
+            else:
+                parsed = {'error': parsed}
+        if parsed['error']:
+            # ничего не записали — транзакцию откатит выход из with
+            connection.rollback()
+            return {'error': parsed['error'], 'stages': parsed.get('stages', []) + timer.report()}
+
+        with timer.stage('refresh'):
+            _refresh_history_stats(connection, touched_flights)
+        connection.execute(
+            "INSERT INTO imports (file_hash, imported_at, total_rows, skipped_rows) VALUES (?, ?, ?, ?)",
+            (file_hash, datetime.now().isoformat(timespec='seconds'), parsed['total_rows'], parsed['skipped_rows']))
+        if parsed['has_den_brd']:
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('has_den_brd', '1')")
+        connection.execute(
+            "INSERT OR REPLACE INTO meta (key, value) "
+            "VALUES ('version', COALESCE((SELECT value FROM meta WHERE key = 'version'), 0) + 1)")
+        return {'total_rows': parsed['total_rows'], 'skipped_rows': parsed['skipped_rows'],
+                'already_imported': False, 'stages': parsed['stages'] + timer.report(), 'error': None}
+
+
+def load_history(history_dir):
+    """Готовая статистика из истории в том же виде, что у parse_flights_file (records = None).
+
+    Читает только предрасчитанные таблицы, а не строки рейсов: group_stats и flight_segments
+    растут с числом рейсов, rate_histograms — ещё и с числом корзин (не больше 1 /
+    HISTORY_RATE_RESOLUTION + 1 на пару), но не с глубиной истории.
+    """
+    timer = StageTimer()
+    with timer.stage('load_history'), closing(open_history(history_dir)) as connection, connection:
+        _upgrade_history(connection)
+        stats = pd.read_sql_query(
+            "SELECT flight, weekday, total_bkd, total_nsh, total_den_brd, flights_with_den_brd, count, "
+            "rate_median, rate_std FROM group_stats ORDER BY flight, position", connection,
+            # типы явно: в истории без единой строки (импорт без годных строк) колонки иначе пришли бы object
+            dtype={'weekday': 'int64', 'total_bkd': 'int64', 'total_nsh': 'int64', 'total_den_brd': 'int64',
+                   'flights_with_den_brd': 'int64', 'count': 'int64', 'rate_median': 'float64', 'rate_std': 'float64'},
+        ).set_index(['flight', 'weekday'])
+        histograms = connection.execute("SELECT flight, weekday, rates, counts FROM rate_histograms").fetchall()
+        segments = connection.execute(
+            "SELECT flight, segment, count FROM flight_segments ORDER BY flight, position").fetchall()
+        meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+        total_rows = connection.execute("SELECT COALESCE(SUM(count), 0) FROM group_stats").fetchone()[0]
+
+    with timer.stage('build', rows=total_rows):
+        flight_segments = defaultdict(Counter)
+        for flight, segment, count in segments:
+            flight_segments[flight][segment] = count
+
+        distributions = {(flight, weekday): (np.frombuffer(rates, dtype=np.float64), np.frombuffer(counts, dtype=np.int64))
+                         for flight, weekday, rates, counts in histograms}
+        dataset = _build_dataset(None, _finish_group_stats(stats), distributions, flight_segments,
+                                 has_den_brd=meta.get('has_den_brd') == '1', total_rows=total_rows, skipped_rows=0)
+    # строки по датам читает load_history_index — только когда выбирают период
+    if 'first_day' in meta:
+        dataset['date_range'] = (_from_day_number(int(meta['first_day'])), _from_day_number(int(meta['last_day'])))
+    dataset['stages'] = timer.report()
+    return dataset
+
+
+def load_history_index(history_dir):
+    """DateIndex по всем строкам истории для dataset_window (load_history строки рейсов не читает)."""
+    with closing(open_history(history_dir)) as connection:
+        rows = pd.read_sql_query(
+            "SELECT flight, date AS day, segment, bkd, nsh, den_brd FROM flights ORDER BY flight, date", connection)
+    return DateIndex(CompactRecords(rows))
+
+
+RUSSIAN_DAYS_FULL = {
+    'Monday': 'Понедельник', 'Tuesday': 'Вторник', 'Wednesday': 'Среда',
+    'Thursday': 'Четверг', 'Friday': 'Пятница', 'Saturday': 'Суббота', 'Sunday': 'Воскресенье'
+}
+RUSSIAN_DAYS_SHORT = {
+    'Monday': 'Пн', 'Tuesday': 'Вт', 'Wednesday': 'Ср', 'Thursday': 'Чт',
+    'Friday': 'Пт', 'Saturday': 'Сб', 'Sunday': 'Вс'
+}
+
+
+def most_common_segment(flight_segments, flight):
+    """Самый частый сегмент рейса или 'Не определен'."""
+    counter = flight_segments.get(flight)
+    if counter:
+        return counter.most_common(1)[0][0]
+    return 'Не определен'
+
+
+def forecast_week(day_stats, risk_factor, start_date):
+    """Прогноз NoShow рейса на 7 дней от start_date с учётом коэффициента агрессивности.
+
+    Возвращает список (дата, день недели, статистика дня или None, прогноз по среднему,
+    прогноз по медиане); для дней без данных прогнозы None.
+    """
+    forecast = []
+    for d in range(7):
+        future_date = start_date + timedelta(days=d)
+        day_name = future_date.strftime('%A')
+        s = day_stats.get(day_name)
+        if s:
+            forecast.append((future_date, day_name, s,
+                             s['avg_bookings'] * s['rate'] * risk_factor,
+                             s['avg_bookings'] * s['rate_median'] * risk_factor))
+        else:
+            forecast.append((future_date, day_name, None, None, None))
+    return forecast
+
+
+def weekday_stats_table(day_stats, has_den_brd):
+    """Статистика рейса по дням недели одной таблицей (строка на день, 'Нет данных' — если рейса в этот день не было)."""
+    rows = []
+    for day in DAYS_ORDER:
+        s = day_stats.get(day)
+        row = {'День недели': RUSSIAN_DAYS_FULL[day]}
+        if s:
+            row.update({
+                'Rate': f"{s['rate']:.3f}",
+                '±': f"{s['rate_std']:.3f}",
+                'Медиана': f"{s['rate_median']:.3f}",
+                # числа строками, как и остальные ячейки: в колонке не должно быть смеси типов
+                'Noshow': str(s['total_nsh']),
+                'Bookings': str(s['total_bkd']),
+                'Рейсов': str(s['count']),
+                'Мало данных': "" if s['reliable'] else "⚠️",
+            })
+            if has_den_brd:
+                row['Den Brd'] = (f"🚫 {s['total_den_brd']} пасс., {s['den_brd_share']*100:.0f}% рейсов"
+                                  if s['total_den_brd'] > 0 else "")
+        else:
+            row['Rate'] = "Нет данных"
+        rows.append(row)
+    return pd.DataFrame(rows).fillna("")
+
+
+def forecast_table(day_stats, risk_factor, start_date):
+    """Прогноз forecast_week одной таблицей: дата, день недели, прогноз по среднему и по медиане."""
+    return pd.DataFrame([
+        {
+            'Дата': future_date.strftime('%d.%m.%Y'),
+            'День недели': RUSSIAN_DAYS_FULL[day_name],
+            'NoShow (по среднему)': f"{noshow_mean:.1f}" if s else "Н/Д",
+            'NoShow (по медиане)': f"{noshow_median:.1f}" if s else "Н/Д",
+            'Мало данных': ("" if s['reliable'] else "⚠️") if s else "",
+        }
+        for future_date, day_name, s, noshow_mean, noshow_median in forecast_week(day_stats, risk_factor, start_date)
+    ])
+
+
+def worst_day(day_stats):
+    """День недели с самым высоким NoShow rate (при равенстве — первый по порядку появления)."""
+    return max(day_stats, key=lambda d: day_stats[d]['rate'])
+
+
+def recommended_overbooking(s, risk_factor):
+    """Рекомендуемое число дополнительных мест для дня со статистикой s."""
+    return int(s['avg_bookings'] * s['rate'] * risk_factor)
+
+
+def build_summary_table(flight_day_stats, flights, flight_segments, has_den_brd):
+    """Сводная таблица по рейсам: на каждый день недели rate / медиана, флаги и число наблюдений."""
+    summary_data = []
+
+    for flight in flights:
+        day_stats = flight_day_stats[flight]
+
+        row_data = {
+            'Рейс': flight,
+            'Сегмент': most_common_segment(flight_segments, flight)
+        }
+
+        for day in DAYS_ORDER:
+            s = day_stats.get(day)
+            if s:
+                flag = "" if s['reliable'] else "⚠️"
+                den_flag = " 🚫" if (has_den_brd and s['total_den_brd'] > 0) else ""
+                row_data[RUSSIAN_DAYS_SHORT[day]] = (
+                    f"{s['rate']:.3f} / мед.{s['rate_median']:.3f}"
+                    f"{flag}{den_flag} (n={s['count']})"
+                )
+            else:
+                row_data[RUSSIAN_DAYS_SHORT[day]] = "Н/Д"
+
+        summary_data.append(row_data)
+
+    return pd.DataFrame(summary_data)
+
+
+def summary_csv(summary_df):
+    """Текст CSV сводной таблицы — ровно то, что отдаёт кнопка скачивания."""
+    return summary_df.to_csv(index=False, encoding='utf-8-sig')
@@ -0,0 +1,367 @@
+"""Локальный HTTP-сервис с прогнозом NoShow в JSON — для скриптов, которые выставляют лимиты овербукинга.
+
+Отдаёт те же цифры, что интерфейс: статистику рейса по дням недели, прогноз на
+неделю и рекомендуемый овербукинг для заданного коэффициента агрессивности, а
+также результат моделирования для рекомендованного уровня:
+
+    python noshow_service.py exports/march.csv exports/april.csv --port 8502
+    python noshow_service.py --history                   # по накопленной истории
+
+    GET /health
+    GET /flights
+    GET /flights/N4-123?risk_factor=0.8&date=2024-05-01
+    GET /forecast?risk_factor=0.8                          # все рейсы одним ответом
+    POST /reload                                           # перечитать данные сейчас
+
+Данные разбираются один раз при запуске, статистика и моделирование считаются
+сразу, а готовые ответы (JSON-байты) кэшируются по запросу. Не чаще раза в
+RELOAD_CHECK_SECONDS сервис проверяет, не изменились ли файлы (время и размер)
+или версия истории, и тогда перечитывает данные в фоне — до конца разбора
+отвечает по старым. Вместе с данными сбрасывается и кэш ответов.
+"""
+import argparse
+from collections import OrderedDict
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from noshow_engine import (
+    DAYS_ORDER, HISTORY_DIR, RUSSIAN_DAYS_FULL, STREAMING_THRESHOLD_BYTES, forecast_week, history_version,
+    load_history, logger, most_common_segment, parse_flights_file, parse_flights_files, recommended_overbooking,
+    stream_flights_file, worst_day,
+)
+from noshow_simulation import simulate_overbooking
+
+
+DEFAULT_PORT = 8502
+
+# Коэффициент агрессивности по умолчанию и допустимые границы — как у слайдера в интерфейсе
+DEFAULT_RISK_FACTOR = 0.8
+RISK_FACTOR_RANGE = (0.3, 1.0)
+
+# Не чаще, чем раз в столько секунд, проверяем, не появились ли новые данные
+RELOAD_CHECK_SECONDS = 2.0
+
+# Сколько готовых ответов держим в памяти (на одну версию данных)
+RESPONSE_CACHE_ENTRIES = 4096
+
+
+class ServiceError(Exception):
+    """Ошибка запроса: HTTP-статус и текст для поля error."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def load_source(paths=None, history_dir=None):
+    """Датасет по файлам выгрузок (как в интерфейсе) или по истории в history_dir."""
+    if history_dir is not None:
+        if not history_version(history_dir):
+            return {'error': "История пуста — загрузите в неё хотя бы одну выгрузку"}
+        return load_history(history_dir)
+    if len(paths) > 1:
+        raw_files = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                raw_files.append(f.read())
+        return parse_flights_files(raw_files, date_index=False)
+    with open(paths[0], 'rb') as f:
+        if os.path.getsize(paths[0]) > STREAMING_THRESHOLD_BYTES:
+            return stream_flights_file(f, date_index=False)
+        return parse_flights_file(f.read(), date_index=False)
+
+
+def source_signature(paths=None, history_dir=None):
+    """То, по чему видно, что данные изменились: версия истории или (время, размер) каждого файла."""
+    if history_dir is not None:
+        return history_version(history_dir)
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+def _weekday_stats(s):
+    """Статистика дня недели из day_stats в JSON-совместимых типах."""
+    return {
+        'count': int(s['count']),
+        'rate': float(s['rate']),
+        'rate_median': float(s['rate_median']),
+        'rate_std': float(s['rate_std']),
+        'avg_bookings': int(s['avg_bookings']),
+        'total_bkd': int(s['total_bkd']),
+        'total_nsh': int(s['total_nsh']),
+        'total_den_brd': int(s['total_den_brd']),
+        'den_brd_share': float(s['den_brd_share']),
+        'reliable': bool(s['reliable']),
+    }
+
+
+class Snapshot:
+    """Одна версия данных: датасет, заранее посчитанное моделирование и кэш готовых ответов."""
+
+    def __init__(self, dataset, signature):
+        self.dataset = dataset
+        self.signature = signature
+        self.loaded_at = datetime.now().isoformat(timespec='seconds')
+        self.flights = sorted(dataset['all_flights'])
+        self.segments = {flight: most_common_segment(dataset['flight_segments'], flight) for flight in self.flights}
+        simulation = simulate_overbooking(dataset['group_stats'], dataset['rate_distributions'])
+        # (рейс, день недели, уровень) -> (пустые кресла, P(Den Brd > 0)): поиск без pandas на каждый запрос
+        self.risk = dict(zip(simulation.index, zip(simulation['expected_empty_seats'].tolist(),
+                                                   simulation['p_denied'].tolist())))
+        self._responses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def flight_forecast(self, flight, risk_factor, start_date):
+        """Ответ по одному рейсу: статистика по дням недели с рекомендацией и прогноз на 7 дней."""
+        day_stats = self.dataset['day_stats'][flight]
+        weekdays = []
+        for weekday, day in enumerate(DAYS_ORDER):
+            s = day_stats.get(day)
+            entry = {'weekday': day, 'weekday_ru': RUSSIAN_DAYS_FULL[day]}
+            if s:
+                level = recommended_overbooking(s, risk_factor)
+                empty_seats, p_denied = self.risk.get((flight, weekday, level), (None, None))
+                entry.update(_weekday_stats(s), recommended_overbooking=level, expected_empty_seats=empty_seats,
+                             p_denied=p_denied)
+            else:
+                entry['count'] = 0
+            weekdays.append(entry)
+
+        forecast = [{
+            'date': future_date.isoformat(),
+            'weekday': day,
+            'noshow_mean': noshow_mean,
+            'noshow_median': noshow_median,
+            'recommended_overbooking': recommended_overbooking(s, risk_factor) if s else None,
+            'reliable': bool(s['reliable']) if s else None,
+        } for future_date, day, s, noshow_mean, noshow_median in forecast_week(day_stats, risk_factor, start_date)]
+
+        return {
+            'flight': flight,
+            'segment': self.segments[flight],
+            'worst_day': worst_day(day_stats) if day_stats else None,
+            'weekdays': weekdays,
+            'forecast': forecast,
+        }
+
+    def cached(self, key, build):
+        """Готовый ответ (байты JSON) по ключу; при первом запросе — build() и сохранить."""
+        with self._lock:
+            body = self._responses.get(key)
+            if body is not None:
+                self._responses.move_to_end(key)
+                return body
+        body = json.dumps(build(), ensure_ascii=False).encode('utf-8')
+        with self._lock:
+            self._responses[key] = body
+            if len(self._responses) > RESPONSE_CACHE_ENTRIES:
+                self._responses.popitem(last=False)
+        return body
+
+
+class ForecastService:
+    """Данные и ответы сервиса без HTTP: handle(метод, путь) -> (статус, байты JSON).
+
+    Источник — файлы выгрузок (paths) или каталог истории (history_dir). Текущая
+    версия данных (Snapshot) подменяется целиком, поэтому запросы, которые уже
+    идут, дорабатывают со своей версией без блокировок.
+    """
+
+    def __init__(self, paths=None, history_dir=None, check_seconds=RELOAD_CHECK_SECONDS):
+        self.paths = list(paths or [])
+        self.history_dir = history_dir
+        self.check_seconds = check_seconds
+        self.snapshot = None
+        self.error = None
+        self._failed_signature = None  # источник, который не удалось разобрать, — не перечитываем его по кругу
+        self._checked_at = 0.0
+        self._reload_lock = threading.Lock()
+
+    def reload(self, force=False):
+        """Перечитывает данные, если источник изменился (или force); True — если данные обновлены."""
+        with self._reload_lock:
+            signature = source_signature(self.paths, self.history_dir)
+            if not force and self.snapshot is not None and self.snapshot.signature == signature:
+                return False
+            started = time.perf_counter()
+            try:
+                dataset = load_source(self.paths, self.history_dir)
+            except OSError as e:
+                dataset = {'error': f"Не удалось прочитать данные: {e}"}
+            if dataset['error']:
+                # старые данные лучше, чем никаких: ошибку показываем в /health, отвечаем по прежней версии
+                self.error = dataset['error']
+                self._failed_signature = signature
+                logger.warning(json.dumps({'event': 'service_reload', 'error': self.error}, ensure_ascii=False))
+                return False
+            self.snapshot = Snapshot(dataset, signature)
+            self.error = None
+            logger.info(json.dumps({'event': 'service_reload', 'flights': len(self.snapshot.flights),
+                                    'total_rows': dataset['total_rows'],
+                                    'seconds': time.perf_counter() - started}, ensure_ascii=False))
+            return True
+
+    def _check_for_updates(self):
+        """Не чаще раза в check_seconds проверяет источник; перечитывание — в фоне, без задержки запроса."""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_seconds or self._reload_lock.locked():
+            return
+        self._checked_at = now
+        signature = source_signature(self.paths, self.history_dir)
+        if signature == self._failed_signature or (self.snapshot is not None and self.snapshot.signature == signature):
+            return
+        threading.Thread(target=self.reload, daemon=True).start()
+
+    def handle(self, method, target):
+        """Ответ на запрос: (HTTP-статус, тело JSON в байтах)."""
+        try:
+            return 200, self._route(method, target)
+        except ServiceError as e:
+            return e.status, json.dumps({'error': str(e)}, ensure_ascii=False).encode('utf-8')
+
+    def _route(self, method, target):
+        url = urlsplit(target)
+        path = url.path.rstrip('/') or '/'
+        query = parse_qs(url.query)
+
+        if method == 'POST':
+            if path != '/reload':
+                raise ServiceError(404, f"Нет такого адреса: {path}")
+            self.reload(force=True)
+            return self._health()
+        if method != 'GET':
+            raise ServiceError(405, f"Метод {method} не поддерживается")
+
+        if path == '/health':
+            return self._health()
+        self._check_for_updates()
+        snapshot = self.snapshot
+        if snapshot is None:
+            raise ServiceError(503, self.error or "Данные ещё не загружены")
+
+        if path == '/flights':
+            return snapshot.cached(('flights',), lambda: {
+                'flights': [{'flight': flight, 'segment': snapshot.segments[flight]} for flight in snapshot.flights]})
+        risk_factor, start_date = _forecast_params(query)
+        if path == '/forecast':
+            return snapshot.cached(('forecast', risk_factor, start_date), lambda: {
+                'risk_factor': risk_factor, 'start_date': start_date.isoformat(),
+                'flights': [snapshot.flight_forecast(flight, risk_factor, start_date) for flight in snapshot.flights]})
+        if path.startswith('/flights/'):
+            flight = unquote(path[len('/flights/'):])
+            if flight not in snapshot.dataset['day_stats']:
+                raise ServiceError(404, f"Рейс {flight} не найден")
+            return snapshot.cached(('flight', flight, risk_factor, start_date), lambda: dict(
+                snapshot.flight_forecast(flight, risk_factor, start_date),
+                risk_factor=risk_factor, start_date=start_date.isoformat()))
+        raise ServiceError(404, f"Нет такого адреса: {path}")
+
+    def _health(self):
+        snapshot = self.snapshot
+        return json.dumps({
+            'status': 'ok' if snapshot is not None and self.error is None else 'error',
+            'error': self.error,
+            'source': {'history_dir': self.history_dir} if self.history_dir is not None else {'files': self.paths},
+            'loaded_at': snapshot.loaded_at if snapshot else None,
+            'flights': len(snapshot.flights) if snapshot else 0,
+            'total_rows': int(snapshot.dataset['total_rows']) if snapshot else 0,
+        }, ensure_ascii=False).encode('utf-8')
+
+
+def _forecast_params(query):
+    """risk_factor и первый день прогноза из строки запроса (по умолчанию 0.8 и сегодня)."""
+    try:
+        risk_factor = round(float(query.get('risk_factor', [DEFAULT_RISK_FACTOR])[0]), 4)
+    except ValueError:
+        raise ServiceError(400, "risk_factor должен быть числом")
+    if not RISK_FACTOR_RANGE[0] <= risk_factor <= RISK_FACTOR_RANGE[1]:
+        raise ServiceError(400, f"risk_factor должен быть от {RISK_FACTOR_RANGE[0]} до {RISK_FACTOR_RANGE[1]}")
+    try:
+        start_date = datetime.strptime(query['date'][0], '%Y-%m-%d').date() if 'date' in query else date.today()
+    except ValueError:
+        raise ServiceError(400, "date должна быть в формате ГГГГ-ММ-ДД")
+    return risk_factor, start_date
+
+
+class ForecastRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive: скрипты, которые шлют сотни запросов подряд, не открывают соединение на каждый
+    protocol_version = 'HTTP/1.1'
+    # заголовки и тело уходят отдельными пакетами; без TCP_NODELAY второй ждёт ACK (~40 мс на запрос)
+    disable_nagle_algorithm = True
+    service = None  # ForecastService, задаёт make_server
+
+    def do_GET(self):
+        self._respond(*self.service.handle('GET', self.path))
+
+    def do_POST(self):
+        self._respond(*self.service.handle('POST', self.path))
+
+    def _respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # строка на каждый запрос при сотнях запросов в секунду только мешает — в лог noshow на уровне DEBUG
+        logger.debug(format, *args)
+
+
+def make_server(service, host='127.0.0.1', port=DEFAULT_PORT):
+    """HTTP-сервер для service (port=0 — любой свободный, например для проверки в тестах)."""
+    handler = type('Handler', (ForecastRequestHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Локальный HTTP-сервис с прогнозом NoShow в JSON.")
+    parser.add_argument('files', nargs='*', help="выгрузки Leonardo (несколько — сливаются, как в интерфейсе)")
+    parser.add_argument('--history', action='store_true', help="брать данные из накопленной истории")
+    parser.add_argument('--history-dir', default=HISTORY_DIR, help="каталог истории (по умолчанию как у интерфейса)")
+    parser.add_argument('--host', default='127.0.0.1', help="адрес (по умолчанию только локальный)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"порт (по умолчанию {DEFAULT_PORT})")
+    parser.add_argument('--verbose', action='store_true', help="писать в stderr перезагрузки данных и запросы")
+    args = parser.parse_args(argv)
+    if bool(args.files) == args.history:
+        parser.error("укажите файлы выгрузок или --history (что-то одно)")
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    service = ForecastService(paths=args.files, history_dir=args.history_dir if args.history else None)
+    service.reload()
+    if service.snapshot is None:
+        print(f"Данные не загружены: {service.error}", file=sys.stderr)
+        if not args.history:
+            return 1
+    server = make_server(service, args.host, args.port)
+    print(f"Сервис прогноза NoShow: http://{args.host}:{server.server_address[1]}/forecast", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
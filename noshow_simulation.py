@@ -0,0 +1,103 @@
+"""Моделирование риска овербукинга (Монте-Карло) по историческим per-flight rate.
+
+Для каждой пары (рейс, день недели) исход рейса — это rate одной из прошлых дат,
+выбранный случайно с учётом частоты. Вместимость считается равной среднему числу
+бронирований (avg_bookings), овербукинг на k мест — это avg_bookings + k проданных
+билетов. По сценариям считаются ожидаемое число пустых кресел и вероятность отказа
+в посадке (Den Brd > 0) для каждого k.
+"""
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+# Число сценариев на каждую пару (рейс, день недели)
+MC_SCENARIOS = 10_000
+
+# Фиксированное зерно: при повторном запуске скрипта (слайдер, выбор рейса) цифры не прыгают
+MC_SEED = 0
+
+
+def overbooking_levels(group_stats):
+    """Уровни овербукинга 0..k_max: k_max с запасом покрывает noshow любой группы (rate + 3 std от avg_bookings)."""
+    if not len(group_stats):
+        return np.arange(1)
+    top = np.ceil(group_stats['avg_bookings'] * (group_stats['rate'] + 3 * group_stats['rate_std'])).max()
+    return np.arange(int(top) + 1)
+
+
+def simulate_overbooking(group_stats, rate_distributions, levels=None, scenarios=MC_SCENARIOS, seed=MC_SEED):
+    """Моделирует scenarios исходов на каждую пару (рейс, день недели) и уровень овербукинга.
+
+    group_stats — таблица compute_group_stats (нужен avg_bookings), rate_distributions —
+    {(рейс, день недели): (значения rate, частоты)} из датасета. Возвращает DataFrame с
+    индексом (flight, weekday, level) и колонками expected_empty_seats, expected_denied
+    и p_denied (доля сценариев с Den Brd > 0).
+
+    Сценарии одной группы — выборка из конечного набора исторических rate, поэтому
+    вместо scenarios отдельных розыгрышей тянется одно мультиномиальное распределение
+    «сколько сценариев выпало на каждое значение» (это та же выборка), а все группы
+    считаются одним массивом (группа × значение) на каждый уровень. Результат
+    воспроизводим: при том же seed у группы всегда те же сценарии.
+    """
+    capacity_by_key = dict(zip(group_stats.index, group_stats['avg_bookings'].to_numpy()))
+    keys = [key for key, bookings in capacity_by_key.items()
+            if bookings > 0 and key in rate_distributions and len(rate_distributions[key][0])]
+    if levels is None:
+        levels = overbooking_levels(group_stats)
+    levels = np.asarray(levels, dtype=np.int64)
+    if not keys:
+        return pd.DataFrame(columns=['expected_empty_seats', 'expected_denied', 'p_denied'],
+                            index=pd.MultiIndex.from_tuples([], names=['flight', 'weekday', 'level']), dtype=float)
+
+    # значения rate групп, дополненные нулевыми частотами до общей ширины; float32 хватает —
+    # число noshow целое и много меньше 2**24, а вдвое меньший массив считается втрое быстрее
+    width = max(len(rate_distributions[key][0]) for key in keys)
+    rates = np.zeros((len(keys), width), dtype=np.float32)
+    weights = np.zeros((len(keys), width), dtype=np.float32)
+    for row, (flight, weekday) in enumerate(keys):
+        values, counts = rate_distributions[(flight, weekday)]
+        rates[row, :len(values)] = values
+        # своё зерно у каждой группы — цифры рейса не зависят от того, какие ещё рейсы моделируются
+        rng = np.random.default_rng([seed, zlib.crc32(flight.encode('utf-8')), int(weekday)])
+        weights[row, :len(values)] = rng.multinomial(scenarios, counts / counts.sum()) / scenarios
+    capacity = np.array([capacity_by_key[key] for key in keys], dtype=np.float32)[:, None]
+
+    expected_over = np.empty((len(keys), len(levels)))
+    expected_denied = np.empty((len(keys), len(levels)))
+    p_denied = np.empty((len(keys), len(levels)))
+    over = np.empty_like(rates)
+    for column, level in enumerate(levels):
+        # over = пришедшие − вместимость = level − noshow: > 0 — отказ в посадке, < 0 — пустые кресла
+        np.multiply(rates, capacity + level, out=over)
+        np.rint(over, out=over)
+        np.subtract(level, over, out=over)
+        expected_over[:, column] = np.einsum('gm,gm->g', over, weights)
+        p_denied[:, column] = np.einsum('gm,gm->g', (over > 0).astype(np.float32), weights)
+        np.maximum(over, 0, out=over)
+        expected_denied[:, column] = np.einsum('gm,gm->g', over, weights)
+
+    index = pd.MultiIndex.from_tuples([(flight, weekday, int(level)) for flight, weekday in keys for level in levels],
+                                      names=['flight', 'weekday', 'level'])
+    # max(−over, 0) = max(over, 0) − over, поэтому пустые кресла — из двух уже посчитанных средних
+    return pd.DataFrame({'expected_empty_seats': (expected_denied - expected_over).ravel(),
+                         'expected_denied': expected_denied.ravel(), 'p_denied': p_denied.ravel()}, index=index)
+
+
+def simulate_flight(group_stats, rate_distributions, flight, levels=None, scenarios=MC_SCENARIOS, seed=MC_SEED):
+    """simulate_overbooking только для дней недели одного рейса (для интерфейса — считается за миллисекунды)."""
+    flight_stats = group_stats[group_stats.index.get_level_values('flight') == flight]
+    return simulate_overbooking(flight_stats, rate_distributions, levels, scenarios, seed)
+
+
+def risk_table(simulation, flight, weekday, recommended_level=None):
+    """Таблица «уровень овербукинга → пустые кресла, отказы, P(Den Brd > 0)» для одной пары (рейс, день недели)."""
+    rows = simulation.xs((flight, weekday), level=['flight', 'weekday'])
+    return pd.DataFrame({
+        'Доп. мест': rows.index,
+        'Пустых кресел (ожид.)': rows['expected_empty_seats'].round(2).to_numpy(),
+        'Отказов в посадке (ожид.)': rows['expected_denied'].round(2).to_numpy(),
+        'P(Den Brd > 0)': [f"{p:.1%}" for p in rows['p_denied']],
+        '': ["◀ рекомендация" if level == recommended_level else "" for level in rows.index],
+    })
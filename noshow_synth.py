@@ -0,0 +1,154 @@
+"""Генератор синтетических выгрузок «Факт вылета» из Leonardo для бенчмарков и проверки разбора.
+
+Файл получается в том же виде, что настоящая выгрузка: пара строк шапки отчёта
+(преамбула), строка заголовка Рейс;Дата;Частота;Сегмент;..., строки рейсов N4-
+и итоговая строка. Можно выбрать кодировку (с BOM и без), убрать колонку Den Brd,
+шапку или саму строку заголовка, переименовать колонки и подмешать битые строки.
+Строки пишутся кусками, так что 10M строк не требуют памяти на весь файл:
+
+    python noshow_synth.py 1m export_1m.csv --encoding utf-8-sig --malformed 0.01
+"""
+import argparse
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ['Рейс', 'Дата', 'Частота', 'Сегмент', 'Тип ВС', 'Кресла', 'Seg Bkd Total', 'Nsh', 'Den Brd',
+           'Go Show', 'Pax', 'Load']
+
+PREAMBLE = ['Отчет "Факт вылета"', 'Период: {start} - {end}', 'Авиакомпания: N4', '']
+
+SEGMENTS = ['SVO-LED', 'LED-SVO', 'SVO-AER', 'AER-SVO', 'VKO-KZN', 'KZN-VKO', 'SVO-OVB', 'OVB-SVO']
+
+# Размер куска, которым строки форматируются и пишутся в файл
+CHUNK_ROWS = 500_000
+
+
+def parse_rows(value):
+    """'10k', '2.5m', '10M', '50000' -> число строк."""
+    value = value.strip().lower().replace('_', '')
+    for suffix, factor in (('k', 1_000), ('m', 1_000_000)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+
+def _flight_profiles(rng, flights, flight_prefix='N4-'):
+    """Для каждого рейса — основной сегмент, вместимость и базовый NoShow rate по дням недели."""
+    return {
+        'name': np.array([f'{flight_prefix}{100 + i}' for i in range(flights)], dtype=object),
+        'segment': rng.integers(0, 2, flights),
+        'seats': rng.choice([150, 168, 180, 189], flights),
+        'rate': rng.uniform(0.03, 0.15, (flights, 7)),
+    }
+
+
+def _date_labels(start, days):
+    """Даты периода в формате выгрузки ('%d.%m.%Y')."""
+    return pd.date_range(start, periods=days, freq='D').strftime('%d.%m.%Y').to_numpy(dtype=object)
+
+
+def _chunk(rng, profiles, rows, start, days, den_brd, malformed):
+    """Кусок выгрузки: словарь колонка -> список ячеек (уже текстом)."""
+    flights = len(profiles['seats'])
+    flight = rng.integers(0, flights, rows)
+    day_offset = rng.integers(0, days, rows)
+    weekday = (start.weekday() + day_offset) % 7
+
+    seats = profiles['seats'][flight]
+    bkd = rng.binomial(seats, 0.85)
+    nsh = rng.binomial(bkd, profiles['rate'][flight, weekday])
+    den = np.where(rng.random(rows) < 0.04, rng.integers(1, 4, rows), 0)
+
+    # 90% рейсов летят своим основным сегментом, остальные — случайным
+    segment = np.where(rng.random(rows) < 0.9, profiles['segment'][flight], rng.integers(0, len(SEGMENTS), rows))
+
+    # номера рейсов, даты и числа форматируются один раз, строки берут готовый текст по индексу
+    numbers = np.array([str(i) for i in range(int(seats.max()) + 1)], dtype=object)
+    table = {
+        'Рейс': profiles['name'][flight],
+        'Дата': _date_labels(start, days)[day_offset],
+        'Частота': np.full(rows, '1234567', dtype=object),
+        'Сегмент': np.array(SEGMENTS, dtype=object)[segment],
+        'Тип ВС': np.full(rows, '320', dtype=object),
+        'Кресла': numbers[seats],
+        'Seg Bkd Total': numbers[bkd],
+        'Nsh': numbers[nsh],
+        'Den Brd': numbers[den],
+        'Go Show': np.full(rows, '0', dtype=object),
+        'Pax': numbers[bkd - nsh],
+        'Load': np.array([f'{i / 100:.2f}' for i in range(201)], dtype=object)[np.rint((bkd - nsh) / seats * 100)
+                                                                               .astype(int)],
+    }
+    if not den_brd:
+        del table['Den Brd']
+
+    # битые строки — те же, что встречаются в реальных выгрузках
+    if malformed > 0:
+        broken = np.flatnonzero(rng.random(rows) < malformed)
+        kind = rng.integers(0, 6, len(broken))
+        table['Дата'][broken[kind == 0]] = '31.02.2023'              # несуществующая дата
+        table['Seg Bkd Total'][broken[kind == 1]] = 'н/д'            # текст вместо числа
+        table['Nsh'][broken[kind == 2]] = ''                         # пустое число (считается 0)
+        table['Рейс'][broken[kind == 3]] = ''                        # строка без рейса
+        table['Seg Bkd Total'][broken[kind == 4]] = table['Seg Bkd Total'][broken[kind == 4]] + '.0'
+        table['Сегмент'][broken[kind == 5]] = '"SVO;LED"'            # ';' внутри поля в кавычках
+    return table
+
+
+def generate_export(path, rows, flights=40, encoding='windows-1251', preamble=True, den_brd=True,
+                    malformed=0.005, start=date(2023, 1, 1), days=730, seed=1, flight_prefix='N4-', header=True,
+                    rename=None):
+    """Пишет синтетическую выгрузку из rows строк рейсов в path.
+
+    encoding='utf-8' — без BOM (utf-8-sig — с ним); flight_prefix — префикс номеров
+    рейсов вместо N4- (пользователи переименовывают рейсы перед загрузкой).
+    header=False — без строки заголовка, rename — {колонка: имя в заголовке}; порядок
+    и содержимое колонок от этого не меняются.
+    """
+    rng = np.random.default_rng(seed)
+    profiles = _flight_profiles(rng, flights, flight_prefix)
+    end = date.fromordinal(start.toordinal() + days - 1)
+    columns = COLUMNS if den_brd else [column for column in COLUMNS if column != 'Den Brd']
+
+    with open(path, 'w', encoding=encoding, newline='') as f:
+        if preamble:
+            f.write('\r\n'.join(PREAMBLE).format(start=start.strftime('%d.%m.%Y'), end=end.strftime('%d.%m.%Y'))
+                    + '\r\n')
+        if header:
+            f.write(';'.join((rename or {}).get(column, column) for column in columns) + '\r\n')
+        for offset in range(0, rows, CHUNK_ROWS):
+            table = _chunk(rng, profiles, min(CHUNK_ROWS, rows - offset), start, days, den_brd, malformed)
+            # одна строка на кусок — кодируется одним вызовом, а не построчно
+            f.write('\r\n'.join(map(';'.join, zip(*(table[column].tolist() for column in columns)))) + '\r\n')
+        f.write('Итого;;;;;\r\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Синтетическая выгрузка «Факт вылета» из Leonardo.")
+    parser.add_argument('rows', type=parse_rows, help="число строк рейсов: 10k, 1m, 10m ...")
+    parser.add_argument('output', help="куда записать CSV")
+    parser.add_argument('--flights', type=int, default=40, help="число разных рейсов N4- (по умолчанию 40)")
+    parser.add_argument('--encoding', choices=['windows-1251', 'utf-8-sig', 'utf-8'], default='windows-1251',
+                        help="utf-8 — без BOM, utf-8-sig — с BOM")
+    parser.add_argument('--flight-prefix', default='N4-', help="префикс номеров рейсов (по умолчанию N4-)")
+    parser.add_argument('--no-preamble', action='store_true', help="без шапки отчёта перед заголовком")
+    parser.add_argument('--no-den-brd', action='store_true', help="без колонки Den Brd (старые выгрузки)")
+    parser.add_argument('--no-header', action='store_true', help="без строки заголовка Рейс;Дата;...")
+    parser.add_argument('--rename', action='append', default=[], metavar='КОЛОНКА=ИМЯ',
+                        help="переименовать колонку в заголовке (можно несколько раз)")
+    parser.add_argument('--malformed', type=float, default=0.005, help="доля битых строк (по умолчанию 0.005)")
+    parser.add_argument('--days', type=int, default=730, help="длина периода в днях от 01.01.2023")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    generate_export(args.output, args.rows, flights=args.flights, encoding=args.encoding,
+                    preamble=not args.no_preamble, den_brd=not args.no_den_brd, malformed=args.malformed,
+                    days=args.days, seed=args.seed, flight_prefix=args.flight_prefix, header=not args.no_header,
+                    rename=dict(item.split('=', 1) for item in args.rename))
+
+
+if __name__ == '__main__':
+    main()